@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pydicom as dcm
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, RLELossless, generate_uid
+
+import us_viewer3 as us
+
+rgb_param = (True, False, True, 128, 128, 128)  # viewer defaults: R >, G <, B >
+std_param = 40.
+
+
+def synthetic_cine(frame_num, rows, cols, seed=0):
+    # Gray speckle sector with pulsing red/blue Doppler blobs, reproducible for a given seed
+    rng = np.random.default_rng(seed)
+    y, x = np.ogrid[:rows, :cols]
+    sector = np.abs(np.arctan2(x - cols / 2., y + 1.)) < 0.7
+
+    image_array = np.empty((frame_num, rows, cols, 3), dtype=np.uint8)
+    for frame_index in range(frame_num):
+        gray = (rng.rayleigh(40., (rows, cols)) * sector).clip(0, 255).astype(np.uint8)
+        frame = np.repeat(gray[:, :, np.newaxis], 3, axis=-1)
+
+        phase = np.sin(2 * np.pi * frame_index / 25.)
+        for center_x, color in ((0.4, (220, 30, 30)), (0.6, (30, 60, 220))):
+            radius = (0.08 + 0.03 * phase) * min(rows, cols)
+            blob = (x - center_x * cols) ** 2 + (y - 0.5 * rows) ** 2 < radius ** 2
+            noise = rng.integers(-25, 25, (int(blob.sum()), 3))
+            frame[blob] = np.clip(np.array(color) + noise, 0, 255)
+        image_array[frame_index] = frame
+    return image_array
+
+
+def write_dicom(dcm_path, image_array, compressed=False):
+    file_meta = FileMetaDataset()
+    file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.3.1'  # US multi-frame
+    file_meta.MediaStorageSOPInstanceUID = generate_uid()
+
+    ds = FileDataset(dcm_path, {}, file_meta=file_meta, preamble=b'\0' * 128)
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    ds.SOPClassUID, ds.SOPInstanceUID = file_meta.MediaStorageSOPClassUID, file_meta.MediaStorageSOPInstanceUID
+    ds.SeriesInstanceUID = generate_uid()
+    ds.NumberOfFrames = image_array.shape[0]
+    ds.Rows, ds.Columns = image_array.shape[1:3]
+    ds.SamplesPerPixel, ds.PhotometricInterpretation, ds.PlanarConfiguration = 3, 'RGB', 0
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 8, 8, 7, 0
+    ds.FrameTime = 33.3
+    ds.PixelData = image_array.tobytes()
+    if compressed:
+        ds.compress(RLELossless)
+    ds.save_as(dcm_path, write_like_original=False)
+
+
+def measure(func, repeat, number=1):
+    # Best of `repeat` runs (least disturbed by other load) and the traced allocation peak of one call
+    seconds = min(timeit.repeat(func, repeat=repeat, number=number)) / number
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def run_benchmarks(args, work_dir):
+    results = []
+
+    def record(name, func, work, unit, repeat=args.repeat):
+        seconds, peak = measure(func, repeat)
+        results.append({'name': name, 'seconds': seconds, 'throughput': work / seconds, 'unit': unit,
+                        'peak_mb': peak / 1024. ** 2})
+        print('%-24s %10.2f ms %12.4g %-7s %8.1f MB' % (name, seconds * 1e3, work / seconds, unit,
+                                                       peak / 1024. ** 2))
+
+    image_array = synthetic_cine(args.frames, args.rows, args.cols, seed=args.seed)
+    frame = image_array[0]
+    x1, y1, x2, y2 = args.cols // 4, args.rows // 4, 3 * args.cols // 4, 3 * args.rows // 4
+    region = (x1, y1, x2, y2)
+    roi_mp = (y2 - y1) * (x2 - x1) / 1e6
+    pixel_mask = us.create_roi_mask('ellipse', y2 - y1, x2 - x1)
+
+    # Per-pixel reference functions are timed on a small ROI; throughput is comparable all the same
+    ref = args.reference
+    concat_mask = np.concatenate((frame[y1:y1 + ref, x1:x1 + ref], us.create_ellipse_mask(ref, ref)), axis=-1)
+
+    def reference_rgb():
+        pixel_result = np.apply_along_axis(lambda x: us.extract_rgb_all(x, *rgb_param), 2, concat_mask.copy())
+        return np.sum(np.apply_along_axis(us.count_value, 2, pixel_result))
+
+    def reference_std():
+        pixel_result = np.apply_along_axis(lambda x: us.extract_std_all(x, std_param), 2, concat_mask.copy())
+        return np.sum(np.apply_along_axis(us.count_value, 2, pixel_result))
+
+    print('%-24s %13s %20s %11s' % ('benchmark', 'time', 'throughput', 'peak'))
+    record('mask_ellipse', lambda: us.create_ellipse_mask(y2 - y1, x2 - x1), roi_mp, 'MP/s')
+    record('reference_rgb', reference_rgb, ref * ref / 1e6, 'MP/s', repeat=1)
+    record('reference_std', reference_std, ref * ref / 1e6, 'MP/s', repeat=1)
+    record('extract_rgb', lambda: us.extract_rgb_array(frame[y1:y2, x1:x2], pixel_mask, *rgb_param),
+           roi_mp, 'MP/s')
+    record('extract_lut', lambda: us.extract_lut_array(frame[y1:y2, x1:x2], pixel_mask, us.rgb_lut(*rgb_param)),
+           roi_mp, 'MP/s')
+    colour_lut = us.colour_lut(np.unique(frame[y1:y2, x1:x2].reshape(-1, 3), axis=0)[::64])
+    record('extract_colour_lut', lambda: us.extract_lut_array(frame[y1:y2, x1:x2], pixel_mask, colour_lut),
+           roi_mp, 'MP/s')
+    record('extract_std', lambda: us.extract_std_array(frame[y1:y2, x1:x2], pixel_mask, std_param), roi_mp, 'MP/s')
+    record('extract_frames_rgb', lambda: us.extract_frames(image_array, pixel_mask, region, 'rgb', rgb_param),
+           args.frames, 'fps')
+    record('extract_frames_std', lambda: us.extract_frames(image_array, pixel_mask, region, 'std', std_param),
+           args.frames, 'fps')
+
+    for compressed in (False, True) if args.compressed else (False,):
+        label = 'rle' if compressed else 'raw'
+        dcm_path = os.path.join(work_dir, 'bench_%s.dcm' % label)
+        write_dicom(dcm_path, image_array, compressed=compressed)
+
+        record('load_first_%s' % label, lambda: us.FrameProvider(dcm_path)[0], 1, 'files/s')
+        record('load_full_%s' % label, lambda: dcm.read_file(dcm_path).pixel_array, args.frames, 'fps')
+
+        def frame_switch():
+            image_frames = us.FrameProvider(dcm_path)
+            for frame_index in range(len(image_frames)):
+                image_frames[frame_index]
+
+        record('frame_switch_%s' % label, frame_switch, args.frames, 'fps')
+        if compressed:
+            record('decode_frames_%s' % label, lambda: us.FrameProvider(dcm_path)[:], args.frames, 'fps')
+            record('decode_frames_%s_1' % label, lambda: us.FrameProvider(dcm_path, max_workers=1)[:],
+                   args.frames, 'fps')
+    return results
+
+
+def compare_results(results, baseline, tolerance):
+    # A benchmark regresses when its throughput drops by more than `tolerance` against the baseline
+    baseline = {result['name']: result for result in baseline['results']}
+    regressed = []
+    print('\n%-24s %10s' % ('vs. baseline', 'ratio'))
+    for result in results:
+        if result['name'] in baseline:
+            ratio = result['throughput'] / baseline[result['name']]['throughput']
+            flag = ' <- regression' if ratio < 1 - tolerance else ''
+            print('%-24s %9.2fx%s' % (result['name'], ratio, flag))
+            if flag:
+                regressed.append(result['name'])
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks of the US viewer extraction, masking and load paths')
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--rows', type=int, default=600)
+    parser.add_argument('--cols', type=int, default=800)
+    parser.add_argument('--reference', type=int, default=48, help='ROI side for the per-pixel reference functions')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compressed', action='store_true', help='also time an RLE compressed copy')
+    parser.add_argument('--work-dir', help='where the synthetic DICOM files are written (default: temp folder)')
+    parser.add_argument('--output', help='save results as JSON')
+    parser.add_argument('--baseline', help='JSON from an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    print('%d frames of %d x %d, seed %d' % (args.frames, args.cols, args.rows, args.seed))
+    if args.work_dir is not None:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = run_benchmarks(args, args.work_dir)
+    else:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = run_benchmarks(args, work_dir)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'config': vars(args), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                       'platform': {'python': platform.python_version(), 'numpy': np.__version__,
+                                    'pydicom': dcm.__version__, 'machine': platform.machine(),
+                                    'processor': platform.processor(), 'cpu_count': os.cpu_count()},
+                       'results': results}, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressed = compare_results(results, json.load(f), args.tolerance)
+        return 1 if len(regressed) > 0 else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+import os
+import sys
+import argparse
+import tempfile
+
+import numpy as np
+
+import us_viewer3 as us
+from us_benchmark import write_dicom
+
+frame_kinds = ('uniform', 'boundary', 'gray', 'sparse', 'extreme')
+mask_kinds = ('ellipse', 'rectangle', 'random', 'none')
+
+
+def reference_extract(image, mask, extract_type, extract_param):
+    # The per-pixel path of the original viewer: mask as a 4th channel, extract_*_all and count_value per pixel
+    concat_mask = np.concatenate((image, mask[:, :, np.newaxis].astype(image.dtype)), axis=-1)
+    if extract_type == 'rgb':
+        pixel_result = np.apply_along_axis(lambda x: us.extract_rgb_all(x, *extract_param), 2, concat_mask)
+    else:
+        pixel_result = np.apply_along_axis(lambda x: us.extract_std_all(x, extract_param), 2, concat_mask)
+    pixel_count = np.sum(np.apply_along_axis(us.count_value, 2, pixel_result))
+    return pixel_result[:, :, 0:3], int(pixel_count)
+
+
+# Fast engines under test: name -> function(image, mask, extract_param) returning (pixel_result, count)
+rgb_engines = {
+    'extract_rgb_array': lambda image, mask, param: us.extract_rgb_array(image, mask, *param),
+    'extract_lut_array': lambda image, mask, param: us.extract_lut_array(image, mask, us.rgb_lut(*param)),
+}
+std_engines = {
+    'extract_std_array': lambda image, mask, param: us.extract_std_array(image, mask, param),
+    'extract_std_array_f64': lambda image, mask, param: us.extract_std_array(image, mask, param, dtype=np.float64),
+}
+
+
+def random_frame(rng, kind, h, w, thresholds):
+    if kind == 'uniform':
+        return rng.integers(0, 256, (h, w, 3), dtype=np.uint8)
+    elif kind == 'boundary':  # every channel on or next to a threshold
+        values = np.array(sorted({min(max(th + d, 0), 255) for th in thresholds for d in (-1, 0, 1)} | {0, 255}))
+        return rng.choice(values, (h, w, 3)).astype(np.uint8)
+    elif kind == 'gray':  # zero stdev, some all-black pixels
+        gray = rng.integers(0, 256, (h, w, 1), dtype=np.uint8) * (rng.random((h, w, 1)) < 0.8)
+        return np.repeat(gray, 3, axis=-1).astype(np.uint8)
+    elif kind == 'sparse':  # mostly black, single non-zero channels
+        frame = np.zeros((h, w, 3), dtype=np.uint8)
+        hit = rng.random((h, w)) < 0.2
+        frame[hit, rng.integers(0, 3, int(hit.sum()))] = rng.integers(1, 256, int(hit.sum()))
+        return frame
+    else:  # 0/1/254/255 only
+        return rng.choice(np.array([0, 1, 254, 255], dtype=np.uint8), (h, w, 3))
+
+
+def random_mask(rng, kind, h, w):
+    if kind == 'ellipse':
+        return us.create_roi_mask('ellipse', h, w)
+    elif kind == 'rectangle':
+        return us.create_roi_mask('rectangle', h, w)
+    elif kind == 'random':
+        return rng.random((h, w)) < 0.5
+    else:
+        return None
+
+
+def random_param(rng, extract_type, frame):
+    if extract_type == 'rgb':
+        directions = tuple(bool(d) for d in rng.integers(0, 2, 3))
+        thresholds = tuple(int(t) for t in rng.choice([0, 1, 127, 128, 254, 255, rng.integers(0, 256)], 3))
+        return directions + thresholds
+    # stdev cutoffs exactly on a stdev present in the frame, plus degenerate ones
+    present = np.std(frame.reshape(-1, 3)[:16], axis=-1)
+    return float(rng.choice(np.concatenate((present, [0., -1., 40., np.inf, np.nan, rng.random() * 128.]))))
+
+
+def first_difference(expected, actual):
+    diff = np.argwhere(np.any(expected != actual, axis=-1))
+    if len(diff) == 0:
+        return None
+    y, x = diff[0]
+    return '(%d, %d): expected %s, got %s' % (x, y, expected[y, x].tolist(), actual[y, x].tolist())
+
+
+def check_case(rng, extract_type, h, w):
+    failures = []
+    frame_kind, mask_kind = rng.choice(frame_kinds), rng.choice(mask_kinds)
+    if extract_type == 'rgb':
+        param = random_param(rng, extract_type, None)
+        frame = random_frame(rng, frame_kind, h, w, param[3:])
+    else:
+        frame = random_frame(rng, frame_kind, h, w, (127, 128))
+        param = random_param(rng, extract_type, frame)
+    mask = random_mask(rng, mask_kind, h, w)
+    ref_mask = np.ones((h, w), dtype=bool) if mask is None else mask
+    expected, expected_count = reference_extract(frame, ref_mask, extract_type, param)
+
+    case = '%s frame, %s mask, param %s' % (frame_kind, mask_kind, param)
+    engines = rgb_engines if extract_type == 'rgb' else std_engines
+    for name, engine in engines.items():
+        pixel_result, pixel_count = engine(frame, mask, param)
+        difference = first_difference(expected, pixel_result[..., 0:3])
+        if difference is not None:
+            failures.append('%s: %s: pixel %s' % (name, case, difference))
+        if pixel_count != expected_count:
+            failures.append('%s: %s: count %d != %d' % (name, case, pixel_count, expected_count))
+    return failures
+
+
+def check_frames(rng, extract_type, frame_num, h, w):
+    # extract_frames over a stack against the reference frame by frame, on a random region
+    failures = []
+    image_array = np.stack([random_frame(rng, rng.choice(frame_kinds), h, w, (127, 128))
+                            for _ in range(frame_num)])
+    param = random_param(rng, extract_type, image_array[0])
+    x1, x2 = sorted(rng.choice(w + 1, 2, replace=False))
+    y1, y2 = sorted(rng.choice(h + 1, 2, replace=False))
+    mask = us.create_roi_mask(rng.choice(['ellipse', 'rectangle']), y2 - y1, x2 - x1)
+
+    expected = [reference_extract(frame[y1:y2, x1:x2], mask, extract_type, param)[1] for frame in image_array]
+    frame_count = us.extract_frames(image_array, mask, (x1, y1, x2, y2), extract_type, param, chunk_size=3)
+    if frame_count.tolist() != expected:
+        failures.append('extract_frames: region %s, param %s: %s != %s'
+                        % ((x1, y1, x2, y2), param, frame_count.tolist(), expected))
+    return failures
+
+
+def check_roi(rng, extract_type, h, w):
+    # count_roi per ROI and union against the reference on each ROI and on the union mask
+    failures = []
+    frame = random_frame(rng, rng.choice(frame_kinds), h, w, (127, 128))
+    param = random_param(rng, extract_type, frame)
+    roi_list = []
+    for _ in range(rng.integers(1, 5)):
+        x1, x2 = sorted(rng.choice(w + 1, 2, replace=False))
+        y1, y2 = sorted(rng.choice(h + 1, 2, replace=False))
+        roi_list.append((str(rng.choice(['ellipse', 'rectangle'])), (int(x1), int(y1), int(x2), int(y2))))
+
+    (bx1, by1, bx2, by2), labels = us.rasterize_roi(roi_list, frame.shape)
+    image_region = frame[by1:by2, bx1:bx2]
+    keep = us.classify_pixel(image_region, extract_type, param)
+    roi_count, union_count = us.count_roi(image_region, labels, keep, len(roi_list))
+
+    expected = [reference_extract(frame[y1:y2, x1:x2], us.create_roi_mask(roi_type, y2 - y1, x2 - x1),
+                                  extract_type, param)[1] for roi_type, (x1, y1, x2, y2) in roi_list]
+    expected_union = reference_extract(image_region, labels != 0, extract_type, param)[1]
+    if roi_count != expected or union_count != expected_union:
+        failures.append('count_roi: %s, param %s: %s / %d != %s / %d'
+                        % (roi_list, param, roi_count, union_count, expected, expected_union))
+    return failures
+
+
+def check_table(rng, extract_type, h, w):
+    # CountTable lookups for random rectangles and ellipses against the reference on the same region
+    failures = []
+    frame = random_frame(rng, rng.choice(frame_kinds), h, w, (127, 128))
+    param = random_param(rng, extract_type, frame)
+    table = us.CountTable(frame, us.classify_pixel(frame, extract_type, param))
+    for _ in range(8):
+        x1, x2 = sorted(rng.choice(w + 1, 2, replace=False))
+        y1, y2 = sorted(rng.choice(h + 1, 2, replace=False))
+        roi_type = str(rng.choice(['ellipse', 'rectangle']))
+        expected = reference_extract(frame[y1:y2, x1:x2], us.create_roi_mask(roi_type, y2 - y1, x2 - x1),
+                                     extract_type, param)[1]
+        table_count = table.count(roi_type, (x1, y1, x2, y2))
+        if table_count != expected:
+            failures.append('CountTable: %s %s, param %s: %d != %d'
+                            % (roi_type, (x1, y1, x2, y2), param, table_count, expected))
+    return failures
+
+
+def check_sweep(rng, extract_type, h, w):
+    # Sweep counts at random thresholds against the reference run with that threshold
+    failures = []
+    frame = random_frame(rng, rng.choice(frame_kinds), h, w, (127, 128))
+    param = random_param(rng, extract_type, frame)
+    mask = random_mask(rng, rng.choice(mask_kinds), h, w)
+    ref_mask = np.ones((h, w), dtype=bool) if mask is None else mask
+    if extract_type == 'rgb':
+        thresholds, counts = us.sweep_rgb(frame, mask, *param)
+        for channel in range(3):
+            for threshold in rng.choice(256, 6):
+                sweep_param = list(param)
+                sweep_param[3 + channel] = int(threshold)
+                expected = reference_extract(frame, ref_mask, extract_type, tuple(sweep_param))[1]
+                if counts[channel, threshold] != expected:
+                    failures.append('sweep_rgb: channel %d, param %s: %d != %d'
+                                    % (channel, tuple(sweep_param), counts[channel, threshold], expected))
+    else:
+        present = np.std(frame.reshape(-1, 3)[:8], axis=-1)
+        thresholds, counts = us.sweep_std(frame, mask, np.concatenate((present, rng.random(4) * 128, [0., 40.])))
+        for threshold, count in zip(thresholds, counts):
+            expected = reference_extract(frame, ref_mask, extract_type, float(threshold))[1]
+            if count != expected:
+                failures.append('sweep_std: threshold %r: %d != %d' % (threshold, count, expected))
+    return failures
+
+
+def check_shared(rng, extractor, work_dir, extract_type, frame_num, h, w):
+    # SharedExtractor against analyze_series on the same raw and RLE files; a region past the frame edge
+    # has to fail in both
+    failures = []
+    image_array = np.stack([random_frame(rng, rng.choice(frame_kinds), h, w, (127, 128))
+                            for _ in range(frame_num)])
+    param = random_param(rng, extract_type, image_array[0])
+    x1, x2 = sorted(rng.choice(w + 1, 2, replace=False))
+    y1, y2 = sorted(rng.choice(h + 1, 2, replace=False))
+    if rng.random() < 0.2:
+        x2 = w + int(rng.integers(1, 4))
+    region, roi_type = (int(x1), int(y1), int(x2), int(y2)), str(rng.choice(['ellipse', 'rectangle']))
+
+    for compressed in (False, True):
+        dcm_path = os.path.join(work_dir, 'shared_%s.dcm' % ('rle' if compressed else 'raw'))
+        write_dicom(dcm_path, image_array, compressed=compressed)
+        results = []
+        for extract in (lambda: us.analyze_series(dcm_path, roi_type, region, extract_type, param, frame_window=3),
+                        lambda: extractor.extract(us.FrameProvider(dcm_path, cache_size=3), roi_type, region,
+                                                  extract_type, param)):
+            try:
+                results.append(extract().tolist())
+            except ValueError:
+                results.append('error')
+        if results[0] != results[1]:
+            failures.append('SharedExtractor: %s %s %s, param %s: %s != %s' % (
+                'rle' if compressed else 'raw', roi_type, region, param, results[1], results[0]))
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Equivalence of the fast extraction engines with the per-pixel '
+                                                 'reference functions')
+    parser.add_argument('--cases', type=int, default=200, help='random frames per extract type')
+    parser.add_argument('--rows', type=int, default=24)
+    parser.add_argument('--cols', type=int, default=32)
+    parser.add_argument('--frames', type=int, default=7)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    failures = []
+    extractor = us.SharedExtractor(max_workers=2, chunk_size=3)
+    with tempfile.TemporaryDirectory() as work_dir:
+        for extract_type in ('rgb', 'std'):
+            rng = np.random.default_rng([args.seed, extract_type == 'std'])
+            checked = 0
+            for case_index in range(args.cases):
+                failures += check_case(rng, extract_type, args.rows, args.cols)
+                if case_index % 10 == 0:
+                    failures += check_frames(rng, extract_type, args.frames, args.rows, args.cols)
+                    failures += check_roi(rng, extract_type, args.rows, args.cols)
+                    failures += check_table(rng, extract_type, args.rows, args.cols)
+                    failures += check_sweep(rng, extract_type, args.rows, args.cols)
+                    failures += check_shared(rng, extractor, work_dir, extract_type, args.frames, args.rows,
+                                             args.cols)
+                checked += 1
+            print('%s: %d cases checked' % (extract_type, checked))
+    extractor.shutdown()
+
+    for failure in failures[:20]:
+        print('MISMATCH ' + failure)
+    if len(failures) > 0:
+        print('%d mismatches (seed %d)' % (len(failures), args.seed))
+        return 1
+    print('All engines match the reference')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
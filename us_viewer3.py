@@ -1,18 +1,35 @@
 import os
 import sys
+import mmap
 import glob
 import re
+import csv
+import json
+import struct
+import argparse
+import time
+import queue
+import hashlib
+import threading
+import functools
+import contextlib
+import tracemalloc
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.transforms import Bbox
 import PyQt5.QtWidgets as Qw
 from PyQt5.QtGui import QIcon
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer
 
 import pydicom as dcm
 import pydicom.uid
+import pydicom.encaps
+from pydicom.pixel_data_handlers.util import pixel_dtype
 import numpy as np
-import timeit
 
 menu_font = ('Helvetica', 12)
 base_font = ('Helvetica', 12)
@@ -28,6 +45,105 @@ rgb_w = 85
 rgb_bw = 30
 type_w = 85
 count_w, window_w = 40, 58
+slider_h = 20
+preview_interval = 40  # ms a threshold must stay still before the live preview updates
+preview_settle = 400  # ms after the last update before the preview overlay is drawn normally again
+default_fps = 30  # cine playback rate when the file has no frame time
+mask_cache_size = 64  # ROI masks memoized by (type, h, w)
+lut_cache_size = 16  # per-channel threshold LUTs kept per setting
+colour_tolerance = 4  # per-channel slack around picked colours, for compression noise
+std_sweep_step = 0.5  # stdev thresholds evaluated by the sensitivity sweep
+index_name = '.us_viewer_index.json'  # header index kept next to the DICOM files
+
+frame_chunk = 32  # frames classified together in extract_frames
+frame_cache_size = 32  # decoded frames kept by each FrameProvider
+frame_window = 8  # uncompressed frames read ahead in one go when the pixel data is not memory-mapped
+decode_workers = os.cpu_count() or 1  # threads decoding compressed frames of one series
+serial_syntaxes = {pydicom.uid.RLELossless}  # pydicom's RLE handler holds the GIL: threads only add overhead
+prefetch_budget = 256 * 1024 ** 2  # bytes of decoded frames warmed across prefetched series
+series_cache_budget = 1024 ** 3  # bytes of decoded frames kept for revisited series
+disk_cache_budget = 20 * 1024 ** 3  # bytes of .npy files kept in the optional on-disk cache
+trace_events = 100000  # stage timings kept for the trace file
+
+
+class StageTimer:
+    # Nested wall-clock timings (and tracemalloc peaks when asked) of named stages, kept as Chrome trace events.
+    # While disabled a timed call costs one attribute check
+
+    def __init__(self, max_events=trace_events):
+        self.enabled, self.track_memory = False, False
+        self.events = deque(maxlen=max_events)
+        self.local = threading.local()
+        self.origin = time.perf_counter()
+        self.report = None  # called with (name, seconds, peak, stages) when an outermost stage ends
+
+    def start(self, track_memory=False):
+        self.track_memory = track_memory
+        if track_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+        if self.track_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.track_memory = False
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        stack = self.local.__dict__.setdefault('stack', [])
+        memory = tracemalloc.is_tracing()
+        if memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if len(stack) > 0:  # the peak is reset per stage, so hand the parent what it has seen so far
+                stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+        entry = {'start_memory': current, 'peak': current, 'stages': OrderedDict()}
+        stack.append(entry)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            peak = max(entry['peak'], tracemalloc.get_traced_memory()[1]) if memory else 0
+            peak_bytes = peak - entry['start_memory']
+
+            self.events.append({'name': name, 'ph': 'X', 'ts': (start - self.origin) * 1e6, 'dur': seconds * 1e6,
+                                'pid': os.getpid(), 'tid': threading.get_ident(),
+                                'args': {'peak_kb': peak_bytes // 1024} if memory else {}})
+            if len(stack) > 0:
+                parent = stack[-1]
+                parent['peak'] = max(parent['peak'], peak)
+                total, calls, stage_peak = parent['stages'].get(name, (0., 0, 0))
+                parent['stages'][name] = (total + seconds, calls + 1, max(stage_peak, peak_bytes))
+            elif self.report is not None and threading.current_thread() is threading.main_thread():
+                self.report(name, seconds, peak_bytes if memory else None, entry['stages'])
+
+    def save(self, trace_path):
+        with open(trace_path, 'w') as f:
+            json.dump({'traceEvents': list(self.events), 'displayTimeUnit': 'ms'}, f)
+
+
+stage_timer = StageTimer()
+
+
+def timed_stage(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not stage_timer.enabled:
+                return func(*args, **kwargs)
+            with stage_timer.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 
 def threshold_process(line_edit):
@@ -100,6 +216,189 @@ def count_value(pixel):
     return count
 
 
+def split_mask(image, mask):
+    # mask: None (whole image), (h, w) or (h, w, 1) like create_ellipse_mask
+    if mask is None:
+        return np.ones(image.shape[:-1], dtype=bool)
+    mask = np.asarray(mask)
+    if mask.shape[-1] == 1 and mask.shape[-3:-1] == image.shape[-3:-1]:
+        mask = mask[..., 0]
+    return mask.astype(bool, copy=False)
+
+
+def classify_rgb(image, r_dir, g_dir, b_dir, r_th, g_th, b_th):
+    # Same boundaries as extract_rgb_all: '>' keeps >= threshold, '<' keeps < threshold
+    keep = None
+    for channel, direction, threshold in ((0, r_dir, r_th), (1, g_dir, g_th), (2, b_dir, b_th)):
+        if direction:
+            criteria = image[..., channel] >= threshold
+        else:
+            criteria = image[..., channel] < threshold
+        keep = criteria if keep is None else np.logical_and(keep, criteria, out=keep)
+    return keep
+
+
+def count_keep(image, mask, keep):
+    # Count per image over the last two pixel axes, so a (frames, h, w, 3) stack gives one count per frame
+    mask = split_mask(image, mask)
+    counted = (image[..., 0] | image[..., 1] | image[..., 2]) != 0
+    counted &= keep
+    counted &= mask
+    return np.count_nonzero(counted, axis=(-2, -1))
+
+
+def extract_keep(image, mask, keep):
+    # Vectorized extract_*_all + count_value: zero rejected pixels inside the mask, count the rest
+    mask = split_mask(image, mask)
+    reject = mask & ~keep
+    pixel_result = image.copy()
+    pixel_result[..., 0:3][reject] = 0
+    return pixel_result, int(count_keep(image, mask, keep))
+
+
+@timed_stage('extract_rgb_array')
+def extract_rgb_array(image, mask, r_dir, g_dir, b_dir, r_th, g_th, b_th):
+    keep = classify_rgb(image, r_dir, g_dir, b_dir, r_th, g_th, b_th)
+    return extract_keep(image, mask, keep)
+
+
+@functools.lru_cache(maxsize=lut_cache_size)
+def rgb_lut(r_dir, g_dir, b_dir, r_th, g_th, b_th):
+    # (3, 256) keep table of the extract_rgb_all rule, one 256-entry LUT per channel. The rule is separable,
+    # so three cache-resident gathers beat one gather into a 16 MB packed table
+    value = np.arange(256)
+    lut = np.stack([value >= threshold if direction else value < threshold
+                    for direction, threshold in ((r_dir, r_th), (g_dir, g_th), (b_dir, b_th))])
+    lut.setflags(write=False)
+    return lut
+
+
+def colour_lut(colours, tolerance=colour_tolerance):
+    # Packed keep table for arbitrary colours (e.g. sampled from the Doppler velocity colour bar),
+    # each colour widened by tolerance on every channel
+    colours = np.asarray(colours, dtype=np.uint8).reshape(-1, 3)
+    cube = np.zeros((256, 256, 256), dtype=bool)
+    cube[colours[:, 0], colours[:, 1], colours[:, 2]] = True
+    for axis in range(3):
+        grown = cube.copy()
+        source, target = np.moveaxis(cube, axis, 0), np.moveaxis(grown, axis, 0)
+        for shift in range(1, tolerance + 1):
+            target[shift:] |= source[:-shift]
+            target[:-shift] |= source[shift:]
+        cube = grown
+    lut = cube.reshape(-1)
+    lut.setflags(write=False)
+    return lut
+
+
+def pack_rgb(image):
+    index = image[..., 0].astype(np.int32)
+    index <<= 8
+    index |= image[..., 1]
+    index <<= 8
+    index |= image[..., 2]
+    return index
+
+
+def classify_lut(image, lut):
+    # Gathers only, so the cost does not depend on the rule that built the table:
+    # per channel for a (3, 256) rgb_lut, one packed gather for a colour_lut
+    if lut.ndim == 2:
+        keep = np.take(lut[0], image[..., 0])
+        keep &= np.take(lut[1], image[..., 1])
+        keep &= np.take(lut[2], image[..., 2])
+        return keep
+    return np.take(lut, pack_rgb(image))
+
+
+@timed_stage('extract_lut_array')
+def extract_lut_array(image, mask, lut):
+    keep = classify_lut(image, lut)
+    return extract_keep(image, mask, keep)
+
+
+def classify_std(image, std, dtype=None):
+    # Same rule as extract_std_all. With dtype=None, 9 * var = 3 * sum(x^2) - sum(x)^2 is computed exactly in
+    # int32 and only pixels within rounding distance of the threshold are re-checked with np.std; a float dtype
+    # (e.g. np.float32 to halve the temporaries) runs np.std over the channel axis directly
+    # Written as 'not below std' like the reference, so a NaN threshold keeps every pixel
+    if dtype is not None:
+        return ~(np.std(image[..., 0:3], axis=-1, dtype=dtype) < std)
+    if not std > 0:
+        return np.ones(image.shape[:-1], dtype=bool)
+    if not np.isfinite(std):
+        return np.zeros(image.shape[:-1], dtype=bool)
+
+    r, g, b = (image[..., channel].astype(np.int32) for channel in range(3))
+    var9 = r * r
+    var9 += g * g
+    var9 += b * b
+    var9 *= 3
+    r += g
+    r += b
+    r *= r
+    var9 -= r
+
+    edge_lo = int(np.floor(9 * (std * (1 - 1e-9)) ** 2))
+    edge_hi = int(np.ceil(9 * (std * (1 + 1e-9)) ** 2))
+    keep = var9 > edge_hi
+    near = (var9 >= edge_lo) & ~keep
+    if near.any():
+        keep[near] = np.std(image[..., 0:3][near], axis=-1) >= std
+    return keep
+
+
+@timed_stage('extract_std_array')
+def extract_std_array(image, mask, std, dtype=None):
+    keep = classify_std(image, std, dtype=dtype)
+    return extract_keep(image, mask, keep)
+
+
+def sweep_rgb(image, mask, r_dir, g_dir, b_dir, r_th, g_th, b_th):
+    # Count for every threshold 0..255 of one channel, the other two kept at their setting: one histogram of
+    # the candidate pixels per channel, summed from the top for '>' and from the bottom for '<'
+    mask = split_mask(image, mask)
+    counted = (image[..., 0] | image[..., 1] | image[..., 2]) != 0
+    counted &= mask
+    channel_keep = [image[..., channel] >= threshold if direction else image[..., channel] < threshold
+                    for channel, direction, threshold in ((0, r_dir, r_th), (1, g_dir, g_th), (2, b_dir, b_th))]
+
+    counts = np.zeros((3, 256), dtype=np.int64)
+    for channel, direction in enumerate((r_dir, g_dir, b_dir)):
+        candidate = counted & channel_keep[channel - 1] & channel_keep[channel - 2]
+        hist = np.bincount(image[..., channel][candidate], minlength=256)
+        if direction:  # keep v >= t
+            counts[channel] = np.cumsum(hist[::-1])[::-1]
+        else:  # keep v < t
+            counts[channel, 1:] = np.cumsum(hist)[:-1]
+    return np.arange(256), counts
+
+
+def sweep_std(image, mask, thresholds=None):
+    # Count for every stdev threshold from the sorted stdevs of the candidate pixels
+    if thresholds is None:
+        thresholds = np.arange(0, 128 + std_sweep_step, std_sweep_step)
+    mask = split_mask(image, mask)
+    counted = (image[..., 0] | image[..., 1] | image[..., 2]) != 0
+    counted &= mask
+    std = np.sort(np.std(image[..., 0:3][counted], axis=-1))
+    counts = len(std) - np.searchsorted(std, thresholds, side='left')  # std >= threshold
+    return np.asarray(thresholds), counts.astype(np.int64)
+
+
+def classify_pixel(image, extract_type, extract_param):
+    # extract_param: (r_dir, g_dir, b_dir, r_th, g_th, b_th) for 'rgb', stdev threshold for 'std',
+    # table from rgb_lut / colour_lut for 'lut'
+    if extract_type == 'rgb':
+        return classify_rgb(image, *extract_param)
+    elif extract_type == 'lut':
+        return classify_lut(image, extract_param)
+    elif extract_type == 'std':
+        return classify_std(image, extract_param)
+    else:
+        raise ValueError('Error!, Invalid extract type!')
+
+
 def index_minus(num, index_total):
     if num <= 0 or num > index_total:
         num = None
@@ -153,6 +452,851 @@ def create_ellipse_mask(h, w):
     return mask
 
 
+@timed_stage('extract_frames')
+def extract_frames(image_array, pixel_mask, region, extract_type, extract_param, chunk_size=frame_chunk):
+    # Count per frame over the whole cine, chunk_size frames at a time to bound the temporaries.
+    # A FrameProvider streams the cropped frames, so the whole series is never held in memory
+    x1, y1, x2, y2 = region
+    if image_array.ndim == 3:  # single frame
+        image_array = image_array[np.newaxis]
+
+    if isinstance(image_array, FrameProvider):
+        blocks = image_array.stream(window=chunk_size, region=region)
+    else:
+        blocks = ((start, image_array[start:start + chunk_size, y1:y2, x1:x2])
+                  for start in range(0, image_array.shape[0], chunk_size))
+
+    frame_count = np.zeros(image_array.shape[0], dtype=np.int64)
+    for start, frame_region in blocks:
+        keep = classify_pixel(frame_region, extract_type, extract_param)
+        frame_count[start:start + len(frame_region)] = count_keep(frame_region, pixel_mask, keep)
+    return frame_count
+
+
+def rasterize_roi(roi_list, frame_shape):
+    # roi_list: [(roi_type, (x1, y1, x2, y2)), ...]; bit k of the label image marks pixels inside ROI k
+    if len(roi_list) > 64:
+        raise ValueError('Error! Too many regions (max 64).')
+    h, w = frame_shape[:2]
+    bx1 = max(min(region[0] for _, region in roi_list), 0)
+    by1 = max(min(region[1] for _, region in roi_list), 0)
+    bx2 = min(max(region[2] for _, region in roi_list), w)
+    by2 = min(max(region[3] for _, region in roi_list), h)
+
+    labels = np.zeros((max(by2 - by1, 0), max(bx2 - bx1, 0)), dtype=np.uint64)
+    for roi_index, (roi_type, (x1, y1, x2, y2)) in enumerate(roi_list):
+        cx1, cy1, cx2, cy2 = max(x1, bx1), max(y1, by1), min(x2, bx2), min(y2, by2)
+        if cx2 <= cx1 or cy2 <= cy1:
+            continue
+        pixel_mask = create_roi_mask(roi_type, y2 - y1, x2 - x1)[cy1 - y1:cy2 - y1, cx1 - x1:cx2 - x1]
+        labels[cy1 - by1:cy2 - by1, cx1 - bx1:cx2 - bx1][pixel_mask] |= np.uint64(1 << roi_index)
+    return (bx1, by1, bx2, by2), labels
+
+
+@timed_stage('count_roi')
+def count_roi(image, labels, keep, roi_num):
+    # Counts per ROI from one classified image: unique label combinations are counted once,
+    # then every ROI sums the combinations containing its bit; the union is the total
+    counted = (image[..., 0] | image[..., 1] | image[..., 2]) != 0
+    counted &= keep
+    counted &= labels != 0
+    combo, combo_count = np.unique(labels[counted], return_counts=True)
+    roi_count = [int(combo_count[(combo >> np.uint64(roi_index)) & np.uint64(1) == 1].sum())
+                 for roi_index in range(roi_num)]
+    return roi_count, int(combo_count.sum())
+
+
+@functools.lru_cache(maxsize=mask_cache_size)
+def roi_spans(roi_type, h, w):
+    # Each row of an ellipse or rectangle mask is one run of pixels: [start, stop) per row
+    mask = create_roi_mask(roi_type, h, w)
+    start = np.argmax(mask, axis=1)
+    stop = start + np.count_nonzero(mask, axis=1)
+    return start, stop
+
+
+class CountTable:
+    # Prefix sums of the counted pixels (classified and not black) of one frame and threshold setting:
+    # a rectangle count is four lookups, an ellipse one lookup pair per row
+
+    @timed_stage('count_table')
+    def __init__(self, image, keep):
+        counted = (image[..., 0] | image[..., 1] | image[..., 2]) != 0
+        counted &= keep
+        h, w = counted.shape
+        self.row_sum = np.zeros((h, w + 1), dtype=np.int32)
+        np.cumsum(counted, axis=1, out=self.row_sum[:, 1:])
+        self.area_sum = np.zeros((h + 1, w + 1), dtype=np.int64)
+        np.cumsum(self.row_sum, axis=0, out=self.area_sum[1:])
+
+    def count(self, roi_type, region):
+        # Same pixels as create_roi_mask(roi_type, y2 - y1, x2 - x1) placed at region, clipped to the frame
+        x1, y1, x2, y2 = region
+        h, w = self.row_sum.shape[0], self.row_sum.shape[1] - 1
+        if roi_type == 'rectangle':
+            cx1, cy1, cx2, cy2 = min(max(x1, 0), w), min(max(y1, 0), h), min(max(x2, 0), w), min(max(y2, 0), h)
+            if cx2 <= cx1 or cy2 <= cy1:
+                return 0
+            area_sum = self.area_sum
+            return int(area_sum[cy2, cx2] - area_sum[cy1, cx2] - area_sum[cy2, cx1] + area_sum[cy1, cx1])
+
+        start, stop = roi_spans(roi_type, y2 - y1, x2 - x1)
+        rows = np.arange(y1, y2)
+        inside = (rows >= 0) & (rows < h)
+        rows = rows[inside]
+        start = np.clip(start[inside] + x1, 0, w)
+        stop = np.clip(stop[inside] + x1, 0, w)
+        return int((self.row_sum[rows, stop] - self.row_sum[rows, start]).sum())
+
+
+def remove_artist(artist):
+    if artist.axes is not None:  # already dropped by ax.clear()
+        artist.remove()
+
+
+@functools.lru_cache(maxsize=mask_cache_size)
+def create_roi_mask(roi_type, h, w):
+    # (h, w) boolean mask, shared between calls and therefore read-only
+    if roi_type == 'ellipse':
+        mask = create_ellipse_mask(h, w)[:, :, 0]
+    elif roi_type == 'rectangle':
+        mask = np.ones((h, w), dtype=bool)
+    else:
+        raise ValueError('Error! Invalid ROI type.')
+    mask.setflags(write=False)
+    return mask
+
+
+def sort_region(start_x, start_y, end_x, end_y):
+    return min(start_x, end_x), min(start_y, end_y), max(start_x, end_x), max(start_y, end_y)
+
+
+class DiskCache:
+    # Decoded series written once as .npy files under cache_dir and memory-mapped when reopened
+
+    def __init__(self, cache_dir, byte_budget=disk_cache_budget):
+        self.cache_dir = cache_dir
+        self.byte_budget = byte_budget
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def series_key(self, dcm_path):
+        # Path, mtime and size: a rewritten file gets a new entry without reading its content
+        mtime_ns, size = file_key(dcm_path)
+        key = '%s|%d|%d' % (os.path.abspath(dcm_path), mtime_ns, size)
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def load(self, key, shape, dtype):
+        npy_path = os.path.join(self.cache_dir, key + '.npy')
+        try:
+            array = np.load(npy_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        if array.shape != tuple(shape) or array.dtype != dtype:
+            del array
+            os.remove(npy_path)
+            return None
+        os.utime(npy_path)  # mtime marks last use for cleanup
+        return array
+
+    def create(self, key, shape, dtype):
+        self.cleanup(reserve=int(np.prod(shape)) * np.dtype(dtype).itemsize)
+        part_path = os.path.join(self.cache_dir, '%s.%d.%d.part' % (key, os.getpid(), threading.get_ident()))
+        return part_path, np.lib.format.open_memmap(part_path, mode='w+', dtype=dtype, shape=tuple(shape))
+
+    def discard(self, part_path):
+        # The caller drops its memmap of part_path first
+        try:
+            os.remove(part_path)
+        except OSError:
+            pass
+
+    def commit(self, key, part_path):
+        # The caller flushes and drops its memmap of part_path first; None when the entry cannot be mapped back
+        npy_path = os.path.join(self.cache_dir, key + '.npy')
+        os.replace(part_path, npy_path)
+        self.cleanup(keep=npy_path)
+        try:
+            return np.load(npy_path, mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+    def save(self, key, array):
+        part_path, store = self.create(key, array.shape, array.dtype)
+        store[:] = array
+        store.flush()
+        del store
+        return self.commit(key, part_path)
+
+    def cleanup(self, part_age=24 * 3600, keep=None, reserve=0):
+        # Oldest entries go until .npy and .part files (plus `reserve` bytes about to be written) fit the budget
+        cache_files, total = [], reserve
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+                if name.endswith('.part') and time.time() - stat.st_mtime > part_age:
+                    os.remove(path)  # left behind by an interrupted write
+                elif name.endswith('.part'):
+                    total += stat.st_size  # being written: counted, never removed here
+                elif name.endswith('.npy'):
+                    total += stat.st_size
+                    if path != keep:  # the entry just committed is never evicted
+                        cache_files.append((stat.st_mtime, stat.st_size, path))
+            except OSError:
+                continue
+
+        for _, size, path in sorted(cache_files):
+            if total <= self.byte_budget:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+
+
+class FrameProvider:
+    # Frame-indexable stand-in for ds.pixel_array: uncompressed pixel data is memory-mapped, compressed frames
+    # are decoded on request and recent ones are kept in a small LRU cache
+
+    @timed_stage('read_header')
+    def __init__(self, dcm_path, cache_size=frame_cache_size, disk_cache=None, max_workers=decode_workers):
+        self.dcm_path = dcm_path
+        self.cache_size = cache_size
+        self.max_workers = max_workers
+        self.frame_cache = OrderedDict()
+        self.value_tell, self.fragments, self.array, self.mmap = None, None, None, None
+        self.disk_cache, self.disk_key, self.store, self.stored = disk_cache, None, None, set()
+
+        with open(dcm_path, 'rb') as f:
+            self.ds = dcm.read_file(f, stop_before_pixels=True)
+            pixel_tell = f.tell()
+
+            transfer_syntax = self.ds.file_meta.TransferSyntaxUID
+            self.is_compressed = transfer_syntax.is_compressed
+            lazy = not transfer_syntax.is_deflated and self.ds.get('BitsAllocated', 0) % 8 == 0
+            # Raw 4:2:2 YBR keeps 2 bytes per pixel, not rows * cols * samples: left to pixel_array
+            if not self.is_compressed and self.ds.get('PhotometricInterpretation') in ('YBR_FULL_422',
+                                                                                        'YBR_PARTIAL_422'):
+                lazy = False
+            if lazy:
+                self.value_tell, value_length = self.read_pixel_header(f, pixel_tell)
+                lazy = self.value_tell is not None and (value_length == 0xFFFFFFFF) == self.is_compressed
+
+        rows, cols = self.ds.Rows, self.ds.Columns
+        self.samples = self.ds.get('SamplesPerPixel', 1)
+        self.frame_num = int(self.ds.get('NumberOfFrames', 1) or 1)
+        self.shape = (self.frame_num, rows, cols) + ((self.samples,) if self.samples > 1 else ())
+        self.ndim = len(self.shape)
+        self.frame_bytes = rows * cols * self.samples * self.ds.get('BitsAllocated', 8) // 8
+
+        if lazy and not self.is_compressed:
+            # Pages are read by the OS as frames are touched; stream() hands them back once consumed
+            try:
+                with open(dcm_path, 'rb') as f:
+                    self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                dtype = pixel_dtype(self.ds)
+                self.array = np.frombuffer(self.mmap, dtype=dtype, count=self.frame_num * self.frame_bytes //
+                                           dtype.itemsize, offset=self.value_tell)
+                if self.samples > 1 and self.ds.get('PlanarConfiguration', 0) == 1:
+                    self.array = self.array.reshape(self.frame_num, self.samples, rows, cols).transpose(0, 2, 3, 1)
+                else:
+                    self.array = self.array.reshape(self.shape)
+            except (ValueError, OSError):  # truncated pixel data: read_frames returns what is there
+                self.array, self.mmap = None, None
+
+        # Uncompressed frames are read straight from the file, so only decoded data goes to the disk cache
+        if self.disk_cache is not None and (self.is_compressed or not lazy):
+            self.disk_key = self.disk_cache.series_key(dcm_path)
+            self.array = self.disk_cache.load(self.disk_key, self.shape, pixel_dtype(self.ds))
+        else:
+            self.disk_cache = None
+
+        if not lazy and self.array is None:  # deflated or unusual pixel data: decode everything once
+            self.array = dcm.read_file(dcm_path).pixel_array
+            if self.array.ndim == len(self.shape) - 1:
+                self.array = self.array[np.newaxis]
+            if self.disk_cache is not None:
+                try:
+                    saved = self.disk_cache.save(self.disk_key, self.array)
+                except OSError:  # e.g. disk full: keep the decoded array in memory
+                    saved = None
+                if saved is not None:
+                    self.array = saved
+
+    def read_pixel_header(self, f, pixel_tell):
+        endian = '<' if self.ds.is_little_endian else '>'
+        f.seek(pixel_tell)
+        header = f.read(12)
+        if len(header) < 8 or struct.unpack(endian + 'HH', header[:4]) != (0x7FE0, 0x0010):
+            return None, None
+
+        if self.ds.is_implicit_VR:
+            return pixel_tell + 8, struct.unpack(endian + 'L', header[4:8])[0]
+        elif header[4:6] in (b'OB', b'OW', b'UN'):
+            return pixel_tell + 12, struct.unpack(endian + 'L', header[8:12])[0]
+        else:
+            return pixel_tell + 8, struct.unpack(endian + 'H', header[6:8])[0]
+
+    def __len__(self):
+        return self.frame_num
+
+    @property
+    def nbytes(self):
+        # Bytes held for the series: the whole array when decoded or mapped, the cached frames otherwise
+        if self.array is not None:
+            return self.array.nbytes
+        return sum(frame.nbytes for frame in self.frame_cache.values())
+
+    def __array__(self, dtype=None, copy=None):
+        frames = self[:]
+        return frames if dtype is None else frames.astype(dtype)
+
+    def __getitem__(self, index):
+        if self.array is not None:  # memory-mapped or fully decoded: views, nothing is read yet
+            return self.array[index]
+        elif isinstance(index, tuple):
+            frames = self[index[0]]
+            if isinstance(index[0], slice):
+                return frames[(slice(None),) + index[1:]]
+            return frames[index[1:]]
+        elif isinstance(index, slice):
+            frame_range = range(*index.indices(self.frame_num))
+            if self.is_compressed:
+                return self.decode_frames(frame_range)
+            elif len(frame_range) == 0:
+                return np.empty((0,) + self.shape[1:], dtype=self.frame(0).dtype)
+            first = self.frame(frame_range[0])
+            frames = np.empty((len(frame_range),) + first.shape, dtype=first.dtype)
+            frames[0] = first
+            for k, frame_index in enumerate(frame_range[1:], 1):
+                frames[k] = self.frame(frame_index)
+            return frames
+        else:
+            return self.frame(index)
+
+    def frame(self, index):
+        index = int(index)
+        if index < 0:
+            index += self.frame_num
+        if index < 0 or index >= self.frame_num:
+            raise IndexError('Error! Frame index out of range.')
+
+        if self.array is not None:
+            return self.array[index]
+
+        if index in self.frame_cache:
+            self.frame_cache.move_to_end(index)
+            return self.frame_cache[index]
+
+        if self.is_compressed:
+            decoded = {index: self.decode_frame(index)}
+            self.store_frame(index, decoded[index])
+            if self.array is not None:
+                return self.array[index]
+        else:
+            decoded = self.read_frames(index, min(index + frame_window, self.frame_num))
+
+        for frame_index, frame in decoded.items():
+            self.frame_cache[frame_index] = frame
+            self.frame_cache.move_to_end(frame_index)
+        while len(self.frame_cache) > self.cache_size:
+            self.frame_cache.popitem(last=False)
+        if index not in decoded:
+            raise ValueError('Error! Pixel data ends before frame %d.' % (index + 1))
+        return decoded[index]
+
+    def stream(self, start=0, stop=None, window=frame_chunk, region=None):
+        # Frames start..stop in blocks of at most `window`, cropped to region (x1, y1, x2, y2). Memory-mapped or
+        # decoded series give views; otherwise one block buffer is refilled, so a block is only valid until the
+        # next one and memory stays at `window` frames whatever the file size. The LRU cache is left alone
+        stop = self.frame_num if stop is None else min(stop, self.frame_num)
+        crop = () if region is None else (slice(region[1], region[3]), slice(region[0], region[2]))
+        buffer = None
+        for block_start in range(start, stop, window):
+            block_stop = min(block_start + window, stop)
+            if self.array is not None:
+                yield block_start, self.array[(slice(block_start, block_stop),) + crop]
+                self.release_frames(block_start, block_stop)
+                continue
+
+            if self.is_compressed:  # whole frames, decoded in parallel into the block buffer
+                if buffer is None:
+                    buffer = np.empty((window,) + self.shape[1:], dtype=pixel_dtype(self.ds))
+                frames = self.decode_frames(range(block_start, block_stop), out=buffer[:block_stop - block_start])
+                yield block_start, frames[(slice(None),) + crop]
+                continue
+
+            decoded = self.read_frames(block_start, block_stop)
+            for frame_index in range(block_start, block_stop):
+                if frame_index not in decoded:
+                    raise ValueError('Error! Pixel data ends before frame %d.' % (frame_index + 1))
+                frame = decoded[frame_index][crop]
+                if buffer is None:
+                    buffer = np.empty((window,) + frame.shape, dtype=frame.dtype)
+                buffer[frame_index - block_start] = frame
+            yield block_start, buffer[:block_stop - block_start]
+
+    def release_frames(self, start, stop):
+        # Drop this process's mapped pages of streamed frames so resident memory stays at the window;
+        # they are read again from the page cache if the frames are shown later
+        if self.mmap is None or not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        begin = self.value_tell + start * self.frame_bytes
+        end = self.value_tell + stop * self.frame_bytes
+        begin += -begin % mmap.PAGESIZE
+        end -= end % mmap.PAGESIZE
+        if end > begin:
+            self.mmap.madvise(mmap.MADV_DONTNEED, begin, end - begin)
+
+    def close(self):
+        # Unmaps a memory-mapped series and drops an unfinished disk-cache file; it keeps working afterwards
+        # through windowed read_frames or decoding
+        self.frame_cache.clear()
+        if self.store is not None:
+            self.store = None
+            self.disk_cache.discard(self.store_path)
+            self.disk_cache, self.stored = None, set()
+        if self.mmap is not None:
+            self.array = None
+            try:
+                self.mmap.close()
+            except BufferError:  # frames still referenced elsewhere: unmapped once they are released
+                pass
+            self.mmap = None
+
+    def store_frame(self, index, frame):
+        # Fill the disk cache as frames get decoded; the finished series replaces the frame cache
+        if self.disk_cache is None:
+            return
+        try:
+            if self.store is None:
+                self.store_path, self.store = self.disk_cache.create(self.disk_key, self.shape, frame.dtype)
+            self.store[index] = frame
+            self.stored.add(index)
+            if len(self.stored) == self.frame_num:
+                self.store.flush()
+                self.store = None
+                saved = self.disk_cache.commit(self.disk_key, self.store_path)
+                if saved is not None:  # otherwise frames keep being decoded in memory
+                    self.array = saved
+                    self.frame_cache.clear()
+        except OSError:  # e.g. disk full: keep working without the cache
+            if self.store is not None:
+                self.store = None
+                self.disk_cache.discard(self.store_path)
+            self.disk_cache = None
+
+    @timed_stage('read_frames')
+    def read_frames(self, start, stop):
+        # Uncompressed frames without a mapping: truncated pixel data, which cannot be mapped to full frames,
+        # and series closed on eviction from the SeriesCache while a frame of theirs is still shown
+        with open(self.dcm_path, 'rb') as f:
+            f.seek(self.value_tell + start * self.frame_bytes)
+            buffer = f.read((stop - start) * self.frame_bytes)
+
+        dtype = pixel_dtype(self.ds)
+        frame_count = len(buffer) // self.frame_bytes
+        frames = np.frombuffer(buffer, dtype=dtype, count=frame_count * self.frame_bytes // dtype.itemsize)
+        if self.samples > 1 and self.ds.get('PlanarConfiguration', 0) == 1:
+            frames = frames.reshape(-1, self.samples, *self.shape[1:3]).transpose(0, 2, 3, 1)
+        else:
+            frames = frames.reshape((-1,) + self.shape[1:])
+        return {start + k: frame for k, frame in enumerate(frames)}
+
+    def frame_fragments(self):
+        # Byte ranges of the encapsulated fragments of every frame, found by seeking over item headers
+        if self.fragments is not None:
+            return self.fragments
+
+        endian = '<' if self.ds.is_little_endian else '>'
+        items = []
+        with open(self.dcm_path, 'rb') as f:
+            f.seek(self.value_tell)
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    break
+                group, elem, length = struct.unpack(endian + 'HHL', header)
+                if (group, elem) != (0xFFFE, 0xE000):
+                    break
+                items.append((f.tell(), length))
+                f.seek(length, 1)
+
+            offset_table = []
+            if len(items) > 0 and items[0][1] > 0:
+                f.seek(items[0][0])
+                offset_table = list(struct.unpack(endian + '%dL' % (items[0][1] // 4), f.read(items[0][1])))
+
+        fragments = items[1:]
+        if len(offset_table) == self.frame_num:
+            first_tell = items[0][0] + items[0][1] + 8
+            starts = [first_tell + offset for offset in offset_table]
+            self.fragments = [[item for item in fragments if start <= item[0] < stop]
+                              for start, stop in zip(starts, starts[1:] + [np.inf])]
+        elif len(fragments) == self.frame_num:
+            self.fragments = [[item] for item in fragments]
+        elif self.frame_num == 1:
+            self.fragments = [fragments]
+        else:  # several fragments per frame without offset table: let pydicom split on frame boundaries
+            self.fragments = None
+        return self.fragments
+
+    def frame_bytestream(self, index):
+        fragments = self.frame_fragments()
+        with open(self.dcm_path, 'rb') as f:
+            if fragments is not None:
+                stream = b''
+                for value_tell, length in fragments[index]:
+                    f.seek(value_tell)
+                    stream += f.read(length)
+                return stream
+
+            f.seek(self.value_tell)
+            frames = pydicom.encaps.generate_pixel_data_frame(f.read(), self.frame_num)
+            for frame_index, stream in enumerate(frames):
+                if frame_index == index:
+                    return stream
+
+    @timed_stage('decode_frames')
+    def decode_frames(self, frame_index, out=None):
+        # Frames decoded concurrently on a thread pool (the JPEG/JPEG-LS/JPEG 2000 codecs release the GIL; RLE is
+        # decoded serially), each copied into its slot of the preallocated out. Cached frames are copied, not decoded
+        frame_index = list(frame_index)
+        if out is None:
+            out = np.empty((len(frame_index),) + self.shape[1:], dtype=pixel_dtype(self.ds))
+
+        streams = dict()
+        if self.frame_fragments() is None:  # no fragment table: split the pixel data once for all frames
+            with open(self.dcm_path, 'rb') as f:
+                f.seek(self.value_tell)
+                frames = pydicom.encaps.generate_pixel_data_frame(f.read(), self.frame_num)
+                wanted = set(frame_index)
+                streams = {index: stream for index, stream in enumerate(frames) if index in wanted}
+
+        def decode(k):
+            index = frame_index[k]
+            if index in self.frame_cache:
+                out[k] = self.frame_cache[index]
+            else:
+                self.decode_frame(index, out=out[k], stream=streams.get(index))
+
+        max_workers = min(self.max_workers, len(frame_index))
+        if self.ds.file_meta.TransferSyntaxUID in serial_syntaxes:
+            max_workers = 1
+        if max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(decode, range(len(frame_index))))
+        else:
+            for k in range(len(frame_index)):
+                decode(k)
+
+        for k, index in enumerate(frame_index):  # the disk cache is filled from this thread only
+            if index not in self.stored:
+                self.store_frame(index, out[k])
+        return out
+
+    @timed_stage('decode_frame')
+    def decode_frame(self, index, out=None, stream=None):
+        # One frame from its own fragments; with out, the decoded frame is copied there, as pydicom's handlers
+        # return a new array and take no output buffer
+        frame_ds = dcm.Dataset()
+        frame_ds.file_meta = self.ds.file_meta
+        frame_ds.is_little_endian, frame_ds.is_implicit_VR = self.ds.is_little_endian, self.ds.is_implicit_VR
+        for keyword in ('Rows', 'Columns', 'SamplesPerPixel', 'PhotometricInterpretation', 'PlanarConfiguration',
+                        'BitsAllocated', 'BitsStored', 'HighBit', 'PixelRepresentation'):
+            if keyword in self.ds:
+                setattr(frame_ds, keyword, self.ds.data_element(keyword).value)
+        frame_ds.NumberOfFrames = 1
+        if stream is None:
+            stream = self.frame_bytestream(index)
+        frame_ds.add_new(0x7FE00010, 'OB', pydicom.encaps.encapsulate([stream]))
+        if out is None:
+            return frame_ds.pixel_array
+        out[...] = frame_ds.pixel_array
+        return out
+
+
+def read_header(dcm_path):
+    try:
+        with open(dcm_path, 'rb') as f:
+            ds = dcm.read_file(f, stop_before_pixels=True)
+            # DICOMDIR, SR and other non-image objects end without a Pixel Data element
+            if not ds.file_meta.TransferSyntaxUID.is_deflated:
+                tag = f.read(4)
+                if len(tag) < 4 or struct.unpack(('<' if ds.is_little_endian else '>') + 'HH', tag) != \
+                        (0x7FE0, 0x0010):
+                    raise ValueError('No pixel data')
+        frame_time = ds.get('FrameTime')
+        series_number, instance_number = ds.get('SeriesNumber'), ds.get('InstanceNumber')
+        file_meta = getattr(ds, 'file_meta', None)
+        return {'frames': int(ds.get('NumberOfFrames', 1) or 1),
+                'rows': int(ds.Rows), 'cols': int(ds.Columns),
+                'transfer_syntax': str(file_meta.get('TransferSyntaxUID', '')) if file_meta is not None else '',
+                'frame_time': float(frame_time) if frame_time else None,
+                'series_uid': str(ds.get('SeriesInstanceUID', '')),
+                'series_number': int(series_number) if series_number is not None else None,
+                'instance_uid': str(ds.get('SOPInstanceUID', '')),
+                'instance_number': int(instance_number) if instance_number is not None else None}
+    except Exception as e:  # not a DICOM image: remembered so it is not parsed again
+        return {'error': str(e)}
+
+
+@timed_stage('index_folder')
+def index_folder(set_wd, file_list, max_workers=None):
+    # Header-only index of file_list, reused from the sidecar for files whose mtime and size are unchanged
+    sidecar = read_sidecar(set_wd)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        file_index, changed = index_headers(set_wd, file_list, sidecar, executor)
+    if changed:
+        write_sidecar(set_wd, sidecar)
+    return file_index
+
+
+def read_sidecar(set_wd):
+    try:
+        with open(os.path.join(set_wd, index_name)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return dict()
+
+
+def write_sidecar(set_wd, sidecar):
+    index_path = os.path.join(set_wd, index_name)
+    try:
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(sidecar, f)
+        os.replace(index_path + '.tmp', index_path)
+    except OSError:  # read-only folder: index again next time
+        pass
+
+
+def index_headers(set_wd, file_list, sidecar, executor):
+    # Headers of file_list from the sidecar where still valid, read on executor otherwise; sidecar is updated
+    file_index, stale = dict(), []
+    for dcm_path in file_list:
+        name = os.path.relpath(dcm_path, set_wd)
+        try:
+            key = list(file_key(dcm_path))
+        except OSError:
+            continue
+        entry = sidecar.get(name)
+        if entry is not None and entry['key'] == key:
+            file_index[dcm_path] = entry['header']
+        else:
+            stale.append((dcm_path, name, key))
+
+    headers = executor.map(read_header, [dcm_path for dcm_path, _, _ in stale])
+    for (dcm_path, name, key), header in zip(stale, headers):
+        file_index[dcm_path] = header
+        sidecar[name] = {'key': key, 'header': header}
+    return file_index, len(stale) > 0
+
+
+def is_dicom(dcm_path):
+    # Part 10 files: 128-byte preamble followed by 'DICM'; *.dcm files are taken as they are, like load_image
+    if dcm_path.lower().endswith('.dcm'):
+        return True
+    try:
+        with open(dcm_path, 'rb') as f:
+            return f.read(132)[128:] == b'DICM'
+    except OSError:
+        return False
+
+
+class TreeScanner:
+    # Walks a study tree on a worker thread, indexing headers directory by directory, and queues image files
+    # as they are found; the sidecar is written once the walk is over
+
+    def __init__(self, root, max_workers=8):
+        self.root = root
+        self.max_workers = max_workers
+        self.found = queue.Queue()
+        self.cancel, self.done = threading.Event(), threading.Event()
+        self.file_index = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        sidecar, file_index, changed = read_sidecar(self.root), dict(), False
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for dir_path, dir_names, file_names in os.walk(self.root):
+                if self.cancel.is_set():
+                    break
+                dir_names.sort()
+                dcm_paths = [os.path.join(dir_path, name) for name in sorted(file_names) if name != index_name]
+                dcm_paths = [dcm_path for dcm_path, found in zip(dcm_paths, executor.map(is_dicom, dcm_paths))
+                             if found]
+                dir_index, dir_changed = index_headers(self.root, dcm_paths, sidecar, executor)
+                for dcm_path in dcm_paths:  # DICOMDIR, SR and unreadable files are indexed but not queued
+                    if dcm_path in dir_index and 'error' not in dir_index[dcm_path]:
+                        self.found.put(dcm_path)
+                file_index.update(dir_index)
+                changed = changed or dir_changed
+
+        if not self.cancel.is_set():
+            if changed:
+                write_sidecar(self.root, sidecar)
+            self.file_index = file_index
+        self.done.set()
+
+    def drain(self):
+        dcm_paths = []
+        while True:
+            try:
+                dcm_paths.append(self.found.get_nowait())
+            except queue.Empty:
+                return dcm_paths
+
+    def stop(self):
+        self.cancel.set()
+
+
+def series_order(file_index):
+    # Image files only, grouped by series. Series go by series number, then by their first path (UIDs have no
+    # meaningful order); files within a series by instance number, then by path
+    dcm_paths = sorted(dcm_path for dcm_path, header in file_index.items() if 'error' not in header)
+    first_path = dict()
+    for dcm_path in dcm_paths:
+        first_path.setdefault(file_index[dcm_path]['series_uid'], dcm_path)
+
+    def order(dcm_path):
+        header = file_index[dcm_path]
+        series_number = header.get('series_number')  # missing in sidecars written before it was indexed
+        return (series_number is None, series_number or 0, first_path[header['series_uid']],
+                header['instance_number'] is None, header['instance_number'] or 0, dcm_path)
+    return sorted(dcm_paths, key=order)
+
+
+def prefetch_series(dcm_path, start_index, byte_budget, cancel, disk_cache=None, cache_size=frame_cache_size):
+    image_array = FrameProvider(dcm_path, cache_size=cache_size, disk_cache=disk_cache)
+    frame_limit = min(image_array.cache_size, byte_budget // max(image_array.frame_bytes, 1))
+    for frame_index in range(start_index, min(start_index + frame_limit, len(image_array))):
+        if cancel.is_set():
+            break
+        image_array.frame(frame_index)
+    return image_array
+
+
+def file_key(dcm_path):
+    stat = os.stat(dcm_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def close_prefetched(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+class SeriesCache:
+    # LRU of opened series within byte_budget; entries are keyed by path and checked against mtime/size
+
+    def __init__(self, byte_budget=series_cache_budget, keep_series=True):
+        self.byte_budget = byte_budget
+        self.keep_series = keep_series  # False: providers keep their own frame window
+        self.series = OrderedDict()  # dcm_path: (file_key, FrameProvider)
+        self.hit, self.miss = 0, 0
+
+    def valid(self, dcm_path):
+        entry = self.series.get(dcm_path)
+        if entry is None:
+            return False
+        try:
+            if entry[0] == file_key(dcm_path):
+                return True
+        except OSError:
+            pass
+        self.series.pop(dcm_path)[1].close()  # changed or removed on disk
+        return False
+
+    def get(self, dcm_path):
+        if self.valid(dcm_path):
+            self.hit += 1
+            self.series.move_to_end(dcm_path)
+            self.evict()
+            return self.series[dcm_path][1]
+        self.miss += 1
+        return None
+
+    def put(self, dcm_path, image_array):
+        # With keep_series, a cached series keeps every frame it decodes while they fit the budget,
+        # so a revisit reads nothing
+        if self.keep_series:
+            frame_limit = self.byte_budget // max(image_array.frame_bytes, 1)
+            image_array.cache_size = max(image_array.cache_size, min(len(image_array), frame_limit))
+        self.series[dcm_path] = (file_key(dcm_path), image_array)
+        self.series.move_to_end(dcm_path)
+        self.evict()
+
+    @property
+    def nbytes(self):
+        return sum(image_array.nbytes for _, image_array in self.series.values())
+
+    def evict(self):
+        # Frames keep being decoded into cached series, so the budget is checked on every access
+        while len(self.series) > 1 and self.nbytes > self.byte_budget:
+            self.series.popitem(last=False)[1][1].close()
+
+    def status(self):
+        return 'Series cache: %d hit / %d miss, %d MB' % (self.hit, self.miss, self.nbytes // 1024 ** 2)
+
+
+class SeriesLoader:
+    # Opens the neighbouring series on worker threads while the current one is reviewed
+
+    def __init__(self, max_workers=2, byte_budget=prefetch_budget, cache_budget=series_cache_budget,
+                 disk_cache=None, cache_size=frame_cache_size, keep_series=True):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.byte_budget = byte_budget
+        self.disk_cache = disk_cache
+        self.cache_size = cache_size  # decoded frames kept per series
+        self.pending = dict()  # dcm_path: (future, cancel event)
+        self.series_cache = SeriesCache(cache_budget, keep_series)
+
+    @timed_stage('open_series')
+    def get(self, dcm_path):
+        image_array = self.series_cache.get(dcm_path)
+        if image_array is not None:
+            return image_array
+
+        future, cancel = self.pending.pop(dcm_path, (None, None))
+        if future is not None and not future.cancelled():
+            try:
+                image_array = future.result()  # waiting on a started load beats starting over
+            except Exception:
+                pass
+        if image_array is None:
+            image_array = FrameProvider(dcm_path, cache_size=self.cache_size, disk_cache=self.disk_cache)
+        self.series_cache.put(dcm_path, image_array)
+        return image_array
+
+    def prefetch(self, dcm_paths, start_index=0):
+        for dcm_path in list(self.pending):
+            if dcm_path not in dcm_paths:
+                self.cancel(dcm_path)
+
+        series_budget = self.byte_budget // max(len(dcm_paths), 1)
+        for dcm_path in dcm_paths:
+            if dcm_path not in self.pending and not self.series_cache.valid(dcm_path):
+                cancel = threading.Event()
+                future = self.executor.submit(prefetch_series, dcm_path, start_index, series_budget, cancel,
+                                              self.disk_cache, self.cache_size)
+                self.pending[dcm_path] = (future, cancel)
+
+    def cancel(self, dcm_path):
+        future, cancel = self.pending.pop(dcm_path)
+        cancel.set()
+        if not future.cancel():  # already running: the series is closed once its prefetch stops
+            future.add_done_callback(close_prefetched)
+
+    def shutdown(self):
+        for dcm_path in list(self.pending):
+            self.cancel(dcm_path)
+        for _, image_array in self.series_cache.series.values():
+            image_array.close()
+        self.executor.shutdown(wait=False)
+
+
 class ViewerUS(Qw.QMainWindow):
     set_wd = None
     file_list, file_num = None, None
@@ -172,14 +1316,35 @@ class ViewerUS(Qw.QMainWindow):
     start_x, start_y, end_x, end_y = dict(), dict(), dict(), dict()
     ext_set = dict()
 
-    def __init__(self):
+    file_index_info = dict()  # dcm_path: header from index_folder
+    tree_scanner = None
+    frame_count = None
+    curve_window = None
+    blit_patch, blit_background = None, None
+    image_artist, result_artist = None, None
+    preview_key, preview_background = None, None
+    colour_lut = None  # picked colours replacing the RGB thresholds
+    table_key, table_param, table = None, None, None  # CountTable of the current frame and thresholds
+
+    def __init__(self, disk_cache_dir=None, frame_window=None, series_budget=series_cache_budget):
         super(ViewerUS, self).__init__()
 
+        # Without a frame window, revisited series keep all their decoded frames within series_budget
+        disk_cache = DiskCache(disk_cache_dir) if disk_cache_dir is not None else None
+        self.frame_window = frame_window or frame_cache_size
+        self.series_loader = SeriesLoader(cache_budget=series_budget, disk_cache=disk_cache,
+                                          cache_size=self.frame_window, keep_series=frame_window is None)
+
         load_action = Qw.QAction(QIcon('load.png'), 'Load...', self)
         load_action.setShortcut('Ctrl+O')
         load_action.setStatusTip('Load DICOM image')
         load_action.triggered.connect(self.load_image)
 
+        tree_action = Qw.QAction(QIcon('load.png'), 'Load Tree...', self)
+        tree_action.setShortcut('Ctrl+Shift+O')
+        tree_action.setStatusTip('Load every DICOM file under a folder, including subfolders')
+        tree_action.triggered.connect(self.load_tree)
+
         exit_action = Qw.QAction(QIcon('exit.png'), 'Exit', self)
         exit_action.setShortcut('Ctrl+Q')
         exit_action.setStatusTip('Exit application')
@@ -190,19 +1355,39 @@ class ViewerUS(Qw.QMainWindow):
         about_action.setStatusTip('View program information')
         about_action.triggered.connect(self.information)
 
+        self.timing_action = Qw.QAction('Record Timings', self, checkable=True)
+        self.timing_action.setShortcut('Ctrl+T')
+        self.timing_action.setStatusTip('Time loading, drawing and extraction stages')
+        self.timing_action.toggled.connect(self.record_timings)
+
+        self.memory_action = Qw.QAction('Track Allocations', self, checkable=True)
+        self.memory_action.setStatusTip('Also record allocation peaks while timing (slower)')
+        self.memory_action.toggled.connect(self.record_timings)
+
+        trace_action = Qw.QAction('Save Trace...', self)
+        trace_action.setStatusTip('Save recorded timings as a Chrome trace (chrome://tracing)')
+        trace_action.triggered.connect(self.save_trace)
+
         self.statusBar()
 
         menu_bar = self.menuBar()
         menu_bar.setNativeMenuBar(False)
         file_menu = menu_bar.addMenu('&File')
         file_menu.addAction(load_action)
+        file_menu.addAction(tree_action)
         file_menu.addAction(exit_action)
 
+        profile_menu = menu_bar.addMenu('&Profile')
+        profile_menu.addAction(self.timing_action)
+        profile_menu.addAction(self.memory_action)
+        profile_menu.addAction(trace_action)
+
         info_menu = menu_bar.addMenu('&Info')
         info_menu.addAction(about_action)
 
         self.fig = plt.Figure(figsize=(fig_width, fig_height), dpi=100)
         self.canvas = FigureCanvas(self.fig)
+        self.canvas.draw = timed_stage('canvas.draw')(self.canvas.draw)  # also covers deferred paints
         self.canvas.setGeometry(296, 30, 960, 720)
 
         self.ax = self.fig.add_subplot(1, 1, 1)
@@ -210,6 +1395,12 @@ class ViewerUS(Qw.QMainWindow):
         self.ax.yaxis.set_visible(False)
         self.fig.tight_layout()
         self.canvas.setParent(self)
+
+        refresh_rate = Qw.QApplication.primaryScreen().refreshRate()
+        self.blit_timer = QTimer(self)
+        self.blit_timer.setSingleShot(True)
+        self.blit_timer.setInterval(int(1000 / refresh_rate) if refresh_rate > 0 else 16)
+        self.blit_timer.timeout.connect(self.draw_blit)
         cnt_h = 30  # Top height
 
         self.file_name = Qw.QLineEdit('Filename', self)
@@ -342,6 +1533,16 @@ class ViewerUS(Qw.QMainWindow):
         self.extract_rgb.setChecked(True)
         extract_group.addButton(self.extract_rgb)
         self.extract_rgb.setGeometry(20, cnt_h, btn_w, btn_h)
+
+        self.lut_check = Qw.QCheckBox('LUT', self)
+        self.lut_check.setGeometry(20 + btn_w + 5, cnt_h, 55, btn_h)
+        self.lut_check.setToolTip('Classify through a colour lookup table built once per threshold setting')
+
+        self.pick_btn = Qw.QPushButton('Pick', self)
+        self.pick_btn.setGeometry(20 + btn_w + 60, cnt_h, btn_w - 55, btn_h)
+        self.pick_btn.setToolTip('Use the colours inside the last region (e.g. the velocity colour bar) '
+                                 'instead of the thresholds')
+        self.pick_btn.clicked.connect(self.pick_colours)
         cnt_h += 25
 
         cnt_w = 0
@@ -426,7 +1627,27 @@ class ViewerUS(Qw.QMainWindow):
         self.value_b1.setGeometry(20 + cnt_w, cnt_h, rgb_w, btn_h)
         self.value_b1.setText('128')
         self.value_b1.setReadOnly(False)
-        cnt_h += 32
+        cnt_h += 27
+
+        cnt_w = 0
+        self.slider_r1 = Qw.QSlider(Qt.Horizontal, self)
+        self.slider_r1.setGeometry(20, cnt_h, rgb_w, slider_h)
+
+        cnt_w += rgb_w + 5
+        self.slider_g1 = Qw.QSlider(Qt.Horizontal, self)
+        self.slider_g1.setGeometry(20 + cnt_w, cnt_h, rgb_w, slider_h)
+
+        cnt_w += rgb_w + 5
+        self.slider_b1 = Qw.QSlider(Qt.Horizontal, self)
+        self.slider_b1.setGeometry(20 + cnt_w, cnt_h, rgb_w, slider_h)
+
+        for slider, value_edit in ((self.slider_r1, self.value_r1), (self.slider_g1, self.value_g1),
+                                   (self.slider_b1, self.value_b1)):
+            slider.setRange(0, 255)
+            slider.setValue(int(value_edit.text()))
+            slider.valueChanged.connect(functools.partial(self.slider_moved, value_edit))
+            value_edit.editingFinished.connect(self.sync_sliders)
+        cnt_h += 25
 
         # 2nd layout or std extract
         self.extract_std = Qw.QRadioButton('Extract to Stdev', self)
@@ -434,15 +1655,27 @@ class ViewerUS(Qw.QMainWindow):
         self.extract_std.setGeometry(20, cnt_h, btn_w, btn_h)
 
         self.edit_std = Qw.QLineEdit('40', self)
-        self.edit_std.setGeometry(20 + btn_w + 5, cnt_h, btn_w, btn_h)
+        self.edit_std.setGeometry(20 + btn_w + 5, cnt_h, 50, btn_h)
+        self.edit_std.editingFinished.connect(self.sync_sliders)
+
+        self.slider_std = Qw.QSlider(Qt.Horizontal, self)
+        self.slider_std.setGeometry(20 + btn_w + 60, cnt_h + 3, btn_w - 55, slider_h)
+        self.slider_std.setRange(0, 128)
+        self.slider_std.setValue(40)
+        self.slider_std.valueChanged.connect(functools.partial(self.slider_moved, self.edit_std))
         cnt_h += 30
 
         self.extract_btn = Qw.QPushButton('Pixel Extract', self)
-        self.extract_btn.setGeometry(20, cnt_h, 265, btn_h)
+        self.extract_btn.setGeometry(20, cnt_h, 265 - 65, btn_h)
         self.extract_btn.setStyleSheet("background-color: rgb(170, 170, 170); color: white")
         # self.extract_btn.clicked.connect(lambda: self.extract_pixel(self.count_window))
         self.extract_btn.clicked.connect(self.extract_pixel)
         self.extract_btn.setShortcut('Alt+s')
+
+        self.live_preview = Qw.QCheckBox('Live', self)
+        self.live_preview.setGeometry(20 + 265 - 55, cnt_h, 55, btn_h)
+        self.live_preview.setToolTip('Update count and overlay of the last region while thresholds change')
+        self.live_preview.toggled.connect(self.live_toggled)
         cnt_h += 32
 
         self.count_label = Qw.QLabel('Count: ', self)
@@ -459,6 +1692,59 @@ class ViewerUS(Qw.QMainWindow):
         self.set_default.clicked.connect(self.default_image)
         self.set_default.setShortcut('Alt+d')
 
+        self.extract_all_btn = Qw.QPushButton('All Frames', self)
+        self.extract_all_btn.setGeometry(20 + btn_w + 5, cnt_h, btn_w, btn_h)
+        self.extract_all_btn.clicked.connect(self.extract_all)
+        self.extract_all_btn.setShortcut('Alt+a')
+        cnt_h += 30
+
+        self.play_btn = Qw.QPushButton('Play', self)
+        self.play_btn.setGeometry(20, cnt_h, btn_w, btn_h)
+        self.play_btn.setStyleSheet("background-color: rgb(140, 140, 140); color: white")
+        self.play_btn.clicked.connect(self.play_cine)
+        self.play_btn.setShortcut('Alt+p')
+
+        self.fps_edit = Qw.QLineEdit(self)
+        self.fps_edit.setGeometry(20 + btn_w + 5, cnt_h, 55, btn_h)
+        self.fps_edit.setPlaceholderText('FPS')
+
+        self.live_count = Qw.QCheckBox('Count', self)
+        self.live_count.setGeometry(20 + btn_w + 65, cnt_h, 70, btn_h)
+        cnt_h += 30
+
+        self.extract_roi_btn = Qw.QPushButton('Extract All Regions', self)
+        self.extract_roi_btn.setGeometry(20, cnt_h, 265 - 65, btn_h)
+        self.extract_roi_btn.setStyleSheet("background-color: rgb(170, 170, 170); color: white")
+        self.extract_roi_btn.clicked.connect(self.extract_roi)
+        self.extract_roi_btn.setShortcut('Alt+r')
+
+        self.sweep_btn = Qw.QPushButton('Sweep', self)
+        self.sweep_btn.setGeometry(20 + 265 - 60, cnt_h, 60, btn_h)
+        self.sweep_btn.setStyleSheet("background-color: rgb(170, 170, 170); color: white")
+        self.sweep_btn.setToolTip('Count of the last region as a function of each threshold')
+        self.sweep_btn.clicked.connect(self.sweep_threshold)
+
+        self.scan_timer = QTimer(self)
+        self.scan_timer.setInterval(100)
+        self.scan_timer.timeout.connect(self.scan_poll)
+
+        self.play_timer = QTimer(self)
+        self.play_timer.setTimerType(Qt.PreciseTimer)
+        self.play_timer.timeout.connect(self.play_tick)
+
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(preview_interval)
+        self.preview_timer.timeout.connect(self.preview)
+
+        self.settle_timer = QTimer(self)
+        self.settle_timer.setSingleShot(True)
+        self.settle_timer.setInterval(preview_settle)
+        self.settle_timer.timeout.connect(self.end_preview)
+
+        for radio in (self.radio_r1_more, self.radio_g1_more, self.radio_b1_more, self.extract_rgb, self.lut_check):
+            radio.toggled.connect(self.schedule_preview)
+
         self.statusBar().showMessage('Ready')
 
     def load_image(self):
@@ -466,41 +1752,129 @@ class ViewerUS(Qw.QMainWindow):
 
         if self.set_wd == '':
             return
-        else:
-            self.file_list = glob.glob(os.path.join(self.set_wd + '/*.dcm'))
+        elif not self.load_folder():
+            self.popup_box("Error!", "Select the folder that contains DICOM file in video format.")
+
+    @timed_stage('load_image')
+    def load_folder(self):
+        # Timed apart from the folder dialog and the popup, so the stage covers indexing and opening only
+        self.stop_scan()
+        self.file_index_info = index_folder(self.set_wd, glob.glob(os.path.join(self.set_wd + '/*.dcm')))
+        self.file_list = series_order(self.file_index_info)
+
+        if len(self.file_list) > 0:
+            self.open_first()
+            return True
+        return False
+
+    def open_first(self):
+        self.file_num = len(self.file_list)
+        self.file_index, self.slice_index = 1, 1
+
+        if not self.open_series():
+            self.popup_box("Error!", "Select the folder that contains DICOM file in video format.")
+            return
+        self.ds = self.image_array.ds
 
-            if len(self.file_list) > 0:
-                self.file_num = len(self.file_list)
-                self.file_index, self.slice_index = 1, 1
+        self.dcm_filename = os.path.basename(self.dcm_path)
+        self.slice_num = len(self.image_array)
+        self.view_image('slice')
+        self.prefetch_series()
 
-                self.dcm_path = self.file_list[self.file_index - 1]
-                self.ds = dcm.read_file(self.dcm_path)
+        self.file_label.setText('%d/%d' % (self.file_index, self.file_num))
+        self.file_name.setText(self.dcm_filename)
+        self.series_info()
 
-                self.dcm_filename = os.path.basename(self.dcm_path)
-                self.image_array = self.ds.pixel_array
-                self.slice_num = self.image_array.shape[0]
-                self.view_image('slice')
+    def load_tree(self):
+        set_wd = Qw.QFileDialog.getExistingDirectory(self, 'Open Folder', self.set_wd)
 
+        if set_wd == '':
+            return
+        else:
+            self.stop_scan()
+            self.set_wd = set_wd
+            self.file_list, self.file_num, self.file_index_info = [], 0, dict()
+            self.tree_scanner = TreeScanner(set_wd)
+            self.scan_timer.start()
+            self.statusBar().showMessage('Scanning...')
+
+    def scan_poll(self):
+        # Files found so far join file_list right away, so review can start before the walk is over
+        dcm_paths = self.tree_scanner.drain()
+        if len(dcm_paths) > 0:
+            self.file_list.extend(dcm_paths)
+            if self.file_num == 0:
+                self.open_first()
+            else:
+                self.file_num = len(self.file_list)
                 self.file_label.setText('%d/%d' % (self.file_index, self.file_num))
-                self.file_name.setText(self.dcm_filename)
+                self.prefetch_series()
+            self.statusBar().showMessage('Scanning... %d files' % self.file_num)
 
+        if self.tree_scanner.done.is_set() and self.tree_scanner.found.empty():
+            self.scan_timer.stop()
+            if self.tree_scanner.file_index is None:
+                return
+            skipped = {dcm_path: header for dcm_path, header in self.file_index_info.items() if 'error' in header}
+            self.file_index_info = self.tree_scanner.file_index
+            self.file_index_info.update(skipped)  # series that failed to open stay out of file_list
+            self.file_list = series_order(self.file_index_info)
+
+            if len(self.file_list) > 0:
+                if self.dcm_path in self.file_list:
+                    self.file_index = self.file_list.index(self.dcm_path) + 1
+                    self.file_num = len(self.file_list)
+                    self.file_label.setText('%d/%d' % (self.file_index, self.file_num))
+                    self.series_info()
+                    self.prefetch_series()
+                else:
+                    self.open_first()
+                self.statusBar().showMessage('Scan done: %d files' % self.file_num)
             else:
+                self.file_num = 0
                 self.popup_box("Error!", "Select the folder that contains DICOM file in video format.")
 
+    def stop_scan(self):
+        if self.tree_scanner is not None:
+            self.tree_scanner.stop()
+            self.scan_timer.stop()
+            self.tree_scanner = None
+
+    def open_series(self):
+        # Opens file_list[file_index - 1]; files that fail to open are dropped and the next one is tried
+        while len(self.file_list) > 0:
+            dcm_path = self.file_list[self.file_index - 1]
+            try:
+                self.image_array = self.series_loader.get(dcm_path)
+                self.dcm_path = dcm_path
+                return True
+            except Exception as e:
+                self.file_list.remove(dcm_path)
+                self.file_index_info[dcm_path] = {'error': str(e)}
+                self.file_num = len(self.file_list)
+                self.file_index = min(self.file_index, max(self.file_num, 1))
+                self.statusBar().showMessage('Skipped %s: %s' % (os.path.basename(dcm_path), e))
+        return False
+
+    @timed_stage('view_image')
     def view_image(self, index_type):
         if index_type == 'file':
-            self.dcm_path = self.file_list[self.file_index - 1]
-            self.ds = dcm.read_file(self.dcm_path)
+            self.stop_cine()
+            if not self.open_series():
+                self.popup_box("Error!", "Select the folder that contains DICOM file in video format.")
+                return
+            self.ds = self.image_array.ds
 
             self.dcm_filename = os.path.basename(self.dcm_path)
-            self.image_array = self.ds.pixel_array
-            self.slice_num = self.image_array.shape[0]
+            self.slice_num = len(self.image_array)
 
             if self.slice_index > self.slice_num:
                 self.slice_index = self.slice_num
             self.dcm_slice = self.image_array[self.slice_index - 1]
             self.file_name.setText(self.dcm_filename)
+            self.series_info()
             self.default_patch()
+            self.prefetch_series()
 
         elif index_type == 'slice':
             self.dcm_slice = self.image_array[self.slice_index - 1]
@@ -510,7 +1884,8 @@ class ViewerUS(Qw.QMainWindow):
             raise ValueError('Error! Invalid index type.')
 
         if self.first_load:
-            self.ax.imshow(self.dcm_slice)
+            self.image_artist = self.ax.imshow(self.dcm_slice)
+            self.ax.set_autoscale_on(False)  # overlays drawn later must not zoom the axes to the ROI
             self.canvas.draw()
 
             self.canvas.callbacks.connect('motion_notify_event', self.motion_coord)
@@ -524,16 +1899,30 @@ class ViewerUS(Qw.QMainWindow):
 
             self.first_load = False
         else:
-            self.ax.clear()
-            self.ax.imshow(self.dcm_slice)
-            self.canvas.draw()
+            self.show_image(self.dcm_slice)
+            self.canvas.draw_idle()  # repeated slice steps collapse into one paint
 
         self.file_label.setText('%d/%d' % (self.file_index, self.file_num))
         self.slice_label.setText('%d/%d' % (self.slice_index, self.slice_num))
 
         self.count_window.setText('')
 
-        self.statusBar().showMessage('Image upload')
+        self.statusBar().showMessage('Image upload  (%s)' % self.series_loader.series_cache.status())
+
+    def series_info(self):
+        header = self.file_index_info.get(self.dcm_path)
+        if header is not None and 'error' not in header:
+            info_text = '%d frames, %d x %d' % (header['frames'], header['cols'], header['rows'])
+            if header['frame_time']:
+                info_text += ', %.1f ms/frame' % header['frame_time']
+            info_text += '\nTransfer syntax: %s\nSeries: %s' % (header['transfer_syntax'], header['series_uid'])
+            self.file_name.setToolTip(info_text)
+            self.file_label.setToolTip(info_text)
+
+    def prefetch_series(self):
+        neighbor_index = [index_plus(self.file_index, self.file_num), index_minus(self.file_index, self.file_num)]
+        dcm_paths = [self.file_list[idx - 1] for idx in neighbor_index if idx != self.file_index]
+        self.series_loader.prefetch(list(dict.fromkeys(dcm_paths)), self.slice_index - 1)
 
     def set_rectangle(self):
         self.canvas.callbacks.disconnect(self.press_event)
@@ -554,6 +1943,25 @@ class ViewerUS(Qw.QMainWindow):
     def patch_load(self):
         for idx in range(1, self.patch_num + 1):
             self.ax.add_patch(self.patch_set[idx])
+            if self.patch_type[idx] == 'ellipse':
+                self.ax.add_patch(self.ellipse_start_set[idx])
+                self.ax.add_patch(self.ellipse_end_set[idx])
+
+    @timed_stage('show_image')
+    def show_image(self, image):
+        # Swap the data of the existing AxesImage; the axes are only rebuilt when the frame size changes
+        self.end_preview(draw=False)
+        if self.image_artist is not None and self.image_artist.get_array().shape == image.shape:
+            self.image_artist.set_data(image)
+            if image.ndim == 2:
+                self.image_artist.autoscale()
+            if self.result_artist is not None:
+                self.result_artist.set_visible(False)
+        else:
+            self.ax.clear()
+            self.image_artist, self.result_artist = self.ax.imshow(image), None
+            self.ax.set_autoscale_on(False)
+            self.patch_load()
 
     def default_patch(self):
         if self.patch_num > 0:
@@ -564,11 +1972,11 @@ class ViewerUS(Qw.QMainWindow):
                 self.end_x.pop(idx)
                 self.end_y.pop(idx)
                 self.ext_set.pop(idx)
-                self.patch_set.pop(idx)
+                remove_artist(self.patch_set.pop(idx))
 
                 if self.patch_type[idx] == 'ellipse':
-                    self.ellipse_start_set.pop(idx)
-                    self.ellipse_end_set.pop(idx)
+                    remove_artist(self.ellipse_start_set.pop(idx))
+                    remove_artist(self.ellipse_end_set.pop(idx))
                 self.patch_num -= 1
         else:
             return
@@ -577,8 +1985,7 @@ class ViewerUS(Qw.QMainWindow):
         if self.first_load is False:
             if self.patch_num > 0:
                 self.default_patch()
-                self.ax.clear()
-                self.ax.imshow(self.dcm_slice)
+                self.show_image(self.dcm_slice)
                 self.canvas.draw()
                 self.statusBar().showMessage('Default image')
             else:
@@ -615,6 +2022,25 @@ class ViewerUS(Qw.QMainWindow):
             self.adj_h_edit.setText(current_height)
             self.adj_w_edit.setText(current_width)
 
+    def count_table(self, extract_type, extract_param):
+        # Built once per (frame, threshold setting); the LUT itself is kept so its id stays unique
+        table_key = (self.dcm_path, self.slice_index, extract_type,
+                     id(extract_param) if isinstance(extract_param, np.ndarray) else extract_param)
+        if self.table_key != table_key:
+            keep = classify_pixel(self.dcm_slice, extract_type, extract_param)
+            self.table_key, self.table_param, self.table = table_key, extract_param, CountTable(self.dcm_slice, keep)
+        return self.table
+
+    def region_count(self, start_x, start_y, end_x, end_y):
+        # Count of the region under the mouse, updated on every move without reclassifying
+        extract_type, extract_param = self.preview_param()
+        x1, y1, x2, y2 = sort_region(start_x, start_y, end_x, end_y)
+        if extract_param is None or abs(x1 - x2) < 2 or abs(y1 - y2) < 2 or self.dcm_slice.ndim != 3:
+            self.count_window.setText('')
+            return
+        table = self.count_table(extract_type, extract_param)
+        self.count_window.setText(str(table.count(self.roi_type(), (x1, y1, x2, y2))))
+
     def ellipse_gen(self, event):
         if event.inaxes is not None and event.button == 1:
             try:
@@ -648,12 +2074,37 @@ class ViewerUS(Qw.QMainWindow):
             self.patch_type[idx] = 'ellipse'
 
             self.cnt_anchor(self.start_x[idx], self.start_y[idx], self.end_x[idx], self.end_y[idx])
+            self.region_count(self.start_x[idx], self.start_y[idx], self.end_x[idx], self.end_y[idx])
 
             self.ext_set[idx] = False
             self.patch_num += 1
         else:
             return
 
+    def start_blit(self, patch):
+        # Render everything but the patch being dragged once, then only blit the patch on top of it
+        patch.set_animated(True)
+        self.canvas.draw()
+        self.blit_patch, self.blit_background = patch, self.canvas.copy_from_bbox(self.ax.bbox)
+
+    def request_blit(self):
+        # Motion events arriving faster than the display refresh are coalesced into one blit
+        if self.blit_patch is not None and not self.blit_timer.isActive():
+            self.blit_timer.start()
+
+    def draw_blit(self):
+        if self.blit_patch is not None:
+            self.canvas.restore_region(self.blit_background)
+            self.ax.draw_artist(self.blit_patch)
+            self.canvas.blit(self.ax.bbox)
+
+    def stop_blit(self):
+        if self.blit_patch is not None:
+            self.blit_timer.stop()
+            self.blit_patch.set_animated(False)
+            self.blit_patch, self.blit_background = None, None
+            self.canvas.draw()
+
     def ellipse_press(self, event):
         if self.draw_mode_h.isChecked():
             if event.inaxes is not None and event.button == 1:
@@ -667,7 +2118,7 @@ class ViewerUS(Qw.QMainWindow):
                                                       width=1, height=1, fill=False, color='gold')
 
                 self.ax.add_patch(self.patch_set[idx])
-                self.canvas.draw()
+                self.start_blit(self.patch_set[idx])
             else:
                 return
         elif self.draw_mode_l.isChecked():
@@ -682,7 +2133,8 @@ class ViewerUS(Qw.QMainWindow):
 
                 self.patch_set[idx].set_height(1 * (int(event.ydata) - self.start_y[idx]))
                 self.patch_set[idx].set_width(1 * (int(event.xdata) - self.start_x[idx]))
-                self.canvas.draw()
+                self.request_blit()
+                self.region_count(self.start_x[idx], self.start_y[idx], int(event.xdata), int(event.ydata))
             else:
                 return
         else:
@@ -690,6 +2142,7 @@ class ViewerUS(Qw.QMainWindow):
 
     def ellipse_release(self, event):
         if self.draw_mode_h.isChecked():
+            self.stop_blit()
             if event.inaxes is not None and event.button == 1:
                 idx = self.patch_num + 1
                 self.ellipse_end_set[idx] = patches.Circle(xy=(int(event.xdata), int(event.ydata)),
@@ -701,6 +2154,7 @@ class ViewerUS(Qw.QMainWindow):
                 self.patch_type[idx] = 'ellipse'
 
                 self.cnt_anchor(self.start_x[idx], self.start_y[idx], self.end_x[idx], self.end_y[idx], hw_edit=True)
+                self.region_count(self.start_x[idx], self.start_y[idx], self.end_x[idx], self.end_y[idx])
 
                 self.ext_set[idx] = False
                 self.patch_num += 1
@@ -729,6 +2183,7 @@ class ViewerUS(Qw.QMainWindow):
             self.patch_type[idx] = 'rectangle'
 
             self.cnt_anchor(self.start_x[idx], self.start_y[idx], self.end_x[idx], self.end_y[idx])
+            self.region_count(self.start_x[idx], self.start_y[idx], self.end_x[idx], self.end_y[idx])
 
             self.ext_set[idx] = False
             self.patch_num += 1
@@ -744,7 +2199,7 @@ class ViewerUS(Qw.QMainWindow):
                 self.patch_set[idx] = patches.Rectangle(xy=(self.start_x[idx], self.start_y[idx]),
                                                         width=1, height=1, fill=False, color='gold')
                 self.ax.add_patch(self.patch_set[idx])
-                self.canvas.draw()
+                self.start_blit(self.patch_set[idx])
             else:
                 return
         else:
@@ -756,7 +2211,8 @@ class ViewerUS(Qw.QMainWindow):
                 idx = self.patch_num + 1
                 self.patch_set[idx].set_height(int(event.ydata) - self.start_y[idx])
                 self.patch_set[idx].set_width(int(event.xdata) - self.start_x[idx])
-                self.canvas.draw()
+                self.request_blit()
+                self.region_count(self.start_x[idx], self.start_y[idx], int(event.xdata), int(event.ydata))
             else:
                 return
         else:
@@ -764,12 +2220,14 @@ class ViewerUS(Qw.QMainWindow):
 
     def rect_release(self, event):
         if self.draw_mode_h.isChecked():
+            self.stop_blit()
             if event.inaxes is not None and event.button == 1:
                 idx = self.patch_num + 1
                 self.end_x[idx], self.end_y[idx] = int(event.xdata), int(event.ydata)
 
                 self.patch_type[idx] = 'rectangle'
                 self.cnt_anchor(self.start_x[idx], self.start_y[idx], self.end_x[idx], self.end_y[idx], hw_edit=True)
+                self.region_count(self.start_x[idx], self.start_y[idx], self.end_x[idx], self.end_y[idx])
 
                 self.ext_set[idx] = False
                 self.patch_num += 1
@@ -781,14 +2239,11 @@ class ViewerUS(Qw.QMainWindow):
     def patch_remove(self, event):
         if event.inaxes is not None and event.button == 2:
             if self.patch_num > 0:
-                self.patch_set[self.patch_num].remove()
-                self.patch_set.pop(self.patch_num)
+                remove_artist(self.patch_set.pop(self.patch_num))
 
                 if self.patch_type[self.patch_num] == 'ellipse':
-                    self.ellipse_start_set[self.patch_num].remove()
-                    self.ellipse_start_set.pop(self.patch_num)
-                    self.ellipse_end_set[self.patch_num].remove()
-                    self.ellipse_end_set.pop(self.patch_num)
+                    remove_artist(self.ellipse_start_set.pop(self.patch_num))
+                    remove_artist(self.ellipse_end_set.pop(self.patch_num))
 
                 self.start_x.pop(self.patch_num)
                 self.start_y.pop(self.patch_num)
@@ -797,7 +2252,7 @@ class ViewerUS(Qw.QMainWindow):
                 self.patch_type.pop(self.patch_num)
 
                 if self.ext_set[self.patch_num]:
-                    self.ax.imshow(self.dcm_slice)
+                    self.show_image(self.dcm_slice)
                     self.ext_set.pop(self.patch_num)
 
                 self.canvas.draw()
@@ -815,55 +2270,217 @@ class ViewerUS(Qw.QMainWindow):
         else:
             raise ValueError('Error!, Invalid extract type!')
 
-    def extract_region(self):
-        zeros_image = np.zeros(self.dcm_slice.shape, dtype=self.dcm_slice.dtype)
+    def roi_region(self):
+        return sort_region(self.start_x[self.patch_num], self.start_y[self.patch_num],
+                           self.end_x[self.patch_num], self.end_y[self.patch_num])
 
-        x1 = min(self.start_x[self.patch_num], self.end_x[self.patch_num])
-        x2 = max(self.start_x[self.patch_num], self.end_x[self.patch_num])
-        y1 = min(self.start_y[self.patch_num], self.end_y[self.patch_num])
-        y2 = max(self.start_y[self.patch_num], self.end_y[self.patch_num])
+    def roi_type(self):
+        return 'ellipse' if self.draw_ellipse.isChecked() else 'rectangle'
 
-        self.set_image = self.dcm_slice - zeros_image
-        adjust_image = self.set_image.copy()
+    @timed_stage('extract_region')
+    def extract_region(self):
+        # View of the ROI in the current frame plus its cached mask; nothing is copied here
+        x1, y1, x2, y2 = self.roi_region()
+        image_region = self.dcm_slice[y1:y2, x1:x2]
 
         if abs(x1 - x2) >= 2 and abs(y1 - y2) >= 2:
-            if self.draw_ellipse.isChecked():
-                pixel_mask = create_ellipse_mask(y2 - y1, x2 - x1)
-            else:
-                pixel_mask = np.expand_dims(np.ones((y2 - y1, x2 - x1), dtype=np.uint8), axis=-1)
-            concat_mask = np.concatenate((adjust_image[y1:y2, x1:x2], pixel_mask), axis=-1)
+            pixel_mask = create_roi_mask(self.roi_type(), y2 - y1, x2 - x1)
         else:
-            concat_mask = None
+            pixel_mask = None
 
-        return x1, y1, x2, y2, adjust_image, concat_mask
+        return x1, y1, x2, y2, image_region, pixel_mask
 
-    def extract_result(self, adjust_image):
-        self.ax.clear()
-        self.ax.imshow(adjust_image)
-        self.patch_load()
+    @timed_stage('extract_result')
+    def extract_result(self, pixel_result, x1, y1, x2, y2):
+        # Only the extracted region is drawn, as an overlay on top of the unchanged frame
+        self.end_preview(draw=False)
+        if self.result_artist is None:
+            self.result_artist = self.ax.imshow(pixel_result, extent=(x1 - 0.5, x2 - 0.5, y2 - 0.5, y1 - 0.5))
+        else:
+            self.result_artist.set_data(pixel_result)
+            self.result_artist.set_extent((x1 - 0.5, x2 - 0.5, y2 - 0.5, y1 - 0.5))
+            self.result_artist.set_visible(True)
         self.canvas.draw()
 
         self.ext_set[self.patch_num] = True
         self.statusBar().showMessage('Done')
 
+    def slider_moved(self, value_edit, value):
+        value_edit.setText(str(value))
+        self.schedule_preview()
+
+    def sync_sliders(self):
+        # Typed thresholds move the sliders without echoing back into the line edits
+        for slider, value_edit in ((self.slider_r1, self.value_r1), (self.slider_g1, self.value_g1),
+                                   (self.slider_b1, self.value_b1), (self.slider_std, self.edit_std)):
+            try:
+                value = int(round(float(value_edit.text())))
+            except ValueError:
+                continue
+            slider.blockSignals(True)
+            slider.setValue(min(max(value, slider.minimum()), slider.maximum()))
+            slider.blockSignals(False)
+        self.schedule_preview()
+
+    def live_toggled(self, checked):
+        if checked:
+            self.schedule_preview()
+        else:
+            self.preview_timer.stop()
+            self.end_preview()
+
+    def schedule_preview(self):
+        # Debounced: every change restarts the single-shot timer, so the preview runs once the threshold rests
+        if self.live_preview.isChecked():
+            self.preview_timer.start()
+
+    def preview_param(self):
+        # Like extract_param but quiet: a half-typed value skips the update instead of raising a popup
+        try:
+            if self.extract_rgb.isChecked():
+                thresholds = [min(max(int(value_edit.text()), 0), 255)
+                              for value_edit in (self.value_r1, self.value_g1, self.value_b1)]
+                return self.rgb_extract((self.radio_r1_more.isChecked(), self.radio_g1_more.isChecked(),
+                                         self.radio_b1_more.isChecked(), *thresholds))
+            return 'std', float(self.edit_std.text())
+        except ValueError:
+            return None, None
+
+    @timed_stage('preview')
+    def preview(self):
+        # Reclassify only the ROI of the last region and blit only its screen rectangle over a cached background
+        if self.first_load or self.patch_num == 0 or self.blit_patch is not None:
+            return
+        extract_type, extract_param = self.preview_param()
+        if extract_param is None:
+            return
+        x1, y1, x2, y2, image_region, pixel_mask = self.extract_region()
+        if pixel_mask is None:
+            return
+
+        keep = classify_pixel(image_region, extract_type, extract_param)
+        pixel_result, pixel_count = extract_keep(image_region, pixel_mask, keep)
+        self.count_window.setText(str(pixel_count))
+
+        preview_key = (self.dcm_path, self.slice_index, self.patch_num, (x1, y1, x2, y2), self.image_artist)
+        if self.preview_background is None or self.preview_key != preview_key or self.result_artist is None:
+            self.end_preview(draw=False)
+            extent = (x1 - 0.5, x2 - 0.5, y2 - 0.5, y1 - 0.5)
+            if self.result_artist is None:
+                self.result_artist = self.ax.imshow(pixel_result, extent=extent)
+            else:
+                self.result_artist.set_extent(extent)
+            self.result_artist.set_animated(True)
+            self.canvas.draw()
+            self.preview_key, self.preview_background = preview_key, self.canvas.copy_from_bbox(self.ax.bbox)
+
+        self.result_artist.set_data(pixel_result)
+        self.result_artist.set_visible(True)
+        self.canvas.restore_region(self.preview_background)
+        self.ax.draw_artist(self.result_artist)
+        for idx in range(1, self.patch_num + 1):
+            self.ax.draw_artist(self.patch_set[idx])
+
+        (left, bottom), (right, top) = self.ax.transData.transform([(x1 - 0.5, y2 - 0.5), (x2 - 0.5, y1 - 0.5)])
+        roi_bbox = Bbox.intersection(Bbox.from_extents(min(left, right), min(bottom, top), max(left, right),
+                                                       max(bottom, top)).padded(2), self.ax.bbox)
+        self.canvas.blit(roi_bbox if roi_bbox is not None else self.ax.bbox)
+
+        self.ext_set[self.patch_num] = True
+        self.settle_timer.start()
+
+    def end_preview(self, draw=True):
+        # Hand the overlay back to normal drawing once the thresholds stop moving
+        self.settle_timer.stop()
+        if self.preview_background is not None:
+            self.preview_key, self.preview_background = None, None
+            if self.result_artist is not None:
+                self.result_artist.set_animated(False)
+            if draw:
+                self.canvas.draw_idle()
+
+    def rgb_param(self):
+        is_r = len(self.value_r1.text()) > 0
+        is_g = len(self.value_g1.text()) > 0
+        is_b = len(self.value_b1.text()) > 0
+
+        if is_r and is_g and is_b:
+            valid_r = re.search('\D', self.value_r1.text())
+            valid_g = re.search('\D', self.value_g1.text())
+            valid_b = re.search('\D', self.value_b1.text())
+
+            if valid_r is None and valid_g is None and valid_b is None:
+                thres_r = threshold_process(self.value_r1)
+                thres_g = threshold_process(self.value_g1)
+                thres_b = threshold_process(self.value_b1)
+                return (self.radio_r1_more.isChecked(), self.radio_g1_more.isChecked(),
+                        self.radio_b1_more.isChecked(), thres_r, thres_g, thres_b)
+            else:
+                self.popup_box('Error!', 'Do not enter characters other than numbers.')
+        else:
+            self.popup_box('Error!', 'Please enter a number between 0 and 255.')
+        return None
+
+    def std_param(self):
+        try:
+            return float(self.edit_std.text())
+        except:
+            self.popup_box('Error!', 'Do not enter characters other than numbers.')
+            return None
+
+    def rgb_extract(self, rgb_param):
+        # RGB mode through comparisons, or through the LUT (picked colours take the place of the thresholds)
+        if rgb_param is None or not self.lut_check.isChecked():
+            return 'rgb', rgb_param
+        elif self.colour_lut is not None:
+            return 'lut', self.colour_lut
+        return 'lut', rgb_lut(*rgb_param)
+
+    def pick_colours(self):
+        if self.colour_lut is not None:
+            self.colour_lut = None
+            self.pick_btn.setText('Pick')
+            self.statusBar().showMessage('Picked colours cleared')
+            self.schedule_preview()
+        elif self.first_load is False:
+            if self.patch_num > 0:
+                x1, y1, x2, y2, image_region, pixel_mask = self.extract_region()
+                if pixel_mask is not None:
+                    colours = np.unique(image_region[pixel_mask].reshape(-1, 3), axis=0)
+                    self.colour_lut = colour_lut(colours)
+                    self.lut_check.setChecked(True)
+                    self.pick_btn.setText('Clear')
+                    self.statusBar().showMessage('Picked %d colours (+/-%d)' % (len(colours), colour_tolerance))
+                    self.schedule_preview()
+                else:
+                    self.popup_box('Error!', 'Selected region is too small for analysis.')
+            else:
+                self.popup_box('Error!', 'Please draw desired region first.')
+        else:
+            self.popup_box('Error!', 'Please upload image.')
+
+    def extract_param(self):
+        if self.extract_rgb.isChecked():
+            return self.rgb_extract(self.rgb_param())
+        elif self.extract_std.isChecked():
+            return 'std', self.std_param()
+        else:
+            raise ValueError('Error!, Invalid extract type!')
+
+    @timed_stage('extract_pixel_std')
     def extract_pixel_std(self, result_window):
         if self.first_load is False:
             if self.patch_num > 0:
-                x1, y1, x2, y2, adjust_image, concat_mask = self.extract_region()
+                x1, y1, x2, y2, image_region, pixel_mask = self.extract_region()
 
-                if concat_mask is not None:
-                    try:
-                        valid_std = float(self.edit_std.text())
-                    except:
-                        self.popup_box('Error!', 'Do not enter characters other than numbers.')
+                if pixel_mask is not None:
+                    valid_std = self.std_param()
+                    if valid_std is None:
                         return
 
-                    pixel_result = np.apply_along_axis(
-                        lambda x: extract_std_all(x, valid_std), 2, concat_mask)
-                    pixel_count = np.sum(np.apply_along_axis(count_value, 2, pixel_result))
+                    pixel_result, pixel_count = extract_std_array(image_region, pixel_mask, valid_std)
                     result_window.setText(str(pixel_count))
-                    adjust_image[y1:y2, x1:x2] = pixel_result[:, :, 0:3]
-                    self.extract_result(adjust_image)
+                    self.extract_result(pixel_result, x1, y1, x2, y2)
                 else:
                     self.popup_box('Error!', 'Selected region is too small for analysis.')
             else:
@@ -871,71 +2488,244 @@ class ViewerUS(Qw.QMainWindow):
         else:
             self.popup_box('Error!', 'Please upload image.')
 
+    @timed_stage('extract_pixel_rgb')
     def extract_pixel_rgb(self, result_window):
         if self.first_load is False:
             if self.patch_num > 0:
-                is_r = len(self.value_r1.text()) > 0
-                is_g = len(self.value_g1.text()) > 0
-                is_b = len(self.value_b1.text()) > 0
-
-                if is_r and is_g and is_b:
-                    valid_r = re.search('\D', self.value_r1.text())
-                    valid_g = re.search('\D', self.value_g1.text())
-                    valid_b = re.search('\D', self.value_b1.text())
-
-                    if valid_r is None and valid_g is None and valid_b is None:
-                        thres_r = threshold_process(self.value_r1)
-                        thres_g = threshold_process(self.value_g1)
-                        thres_b = threshold_process(self.value_b1)
-
-                        x1, y1, x2, y2, adjust_image, concat_mask = self.extract_region()
-
-                        if concat_mask is not None:
-                            pixel_result = np.apply_along_axis(
-                                lambda x: extract_rgb_all(x,
-                                                          self.radio_r1_more.isChecked(),
-                                                          self.radio_g1_more.isChecked(),
-                                                          self.radio_b1_more.isChecked(),
-                                                          thres_r, thres_g, thres_b), 2, concat_mask)
-
-                            pixel_count = np.sum(np.apply_along_axis(count_value, 2, pixel_result))
-                            result_window.setText(str(pixel_count))
-                            adjust_image[y1:y2, x1:x2] = pixel_result[:, :, 0:3]
-                            self.extract_result(adjust_image)
+                rgb_param = self.rgb_param()
+
+                if rgb_param is not None:
+                    x1, y1, x2, y2, image_region, pixel_mask = self.extract_region()
+
+                    if pixel_mask is not None:
+                        extract_type, extract_param = self.rgb_extract(rgb_param)
+                        if extract_type == 'lut':
+                            pixel_result, pixel_count = extract_lut_array(image_region, pixel_mask, extract_param)
                         else:
-                            self.popup_box('Error!', 'Selected region is too small for analysis.')
+                            pixel_result, pixel_count = extract_rgb_array(image_region, pixel_mask, *rgb_param)
+                        result_window.setText(str(pixel_count))
+                        self.extract_result(pixel_result, x1, y1, x2, y2)
                     else:
-                        self.popup_box('Error!', 'Do not enter characters other than numbers.')
+                        self.popup_box('Error!', 'Selected region is too small for analysis.')
+            else:
+                self.popup_box('Error!', 'Please draw desired region first.')
+        else:
+            self.popup_box('Error!', 'Please upload image.')
+
+    @timed_stage('extract_all')
+    def extract_all(self):
+        if self.first_load is False:
+            if self.patch_num > 0:
+                extract_type, extract_param = self.extract_param()
+                if extract_param is None:
+                    return
+
+                x1, y1, x2, y2 = self.roi_region()
+                if abs(x1 - x2) >= 2 and abs(y1 - y2) >= 2:
+                    pixel_mask = create_roi_mask(self.roi_type(), y2 - y1, x2 - x1)
+                    self.frame_count = extract_frames(self.image_array, pixel_mask, (x1, y1, x2, y2),
+                                                      extract_type, extract_param, chunk_size=self.frame_window)
+                    self.count_window.setText(str(self.frame_count[self.slice_index - 1]))
+                    self.plot_curve('Count per frame - %s' % self.dcm_filename,
+                                    np.arange(1, len(self.frame_count) + 1), self.frame_count, 'Frame', 'Count')
+                    self.statusBar().showMessage('Done')
                 else:
-                    self.popup_box('Error!', 'Please enter a number between 0 and 255.')
+                    self.popup_box('Error!', 'Selected region is too small for analysis.')
             else:
                 self.popup_box('Error!', 'Please draw desired region first.')
         else:
             self.popup_box('Error!', 'Please upload image.')
 
-    def file_next(self):
+    @timed_stage('extract_roi')
+    def extract_roi(self):
         if self.first_load is False:
+            if self.patch_num > 0:
+                extract_type, extract_param = self.extract_param()
+                if extract_param is None:
+                    return
+
+                roi_list = []
+                for idx in range(1, self.patch_num + 1):
+                    x1, y1, x2, y2 = sort_region(self.start_x[idx], self.start_y[idx], self.end_x[idx], self.end_y[idx])
+                    if abs(x1 - x2) >= 2 and abs(y1 - y2) >= 2:
+                        roi_list.append((self.patch_type[idx], (x1, y1, x2, y2)))
+                if len(roi_list) == 0:
+                    self.popup_box('Error!', 'Selected region is too small for analysis.')
+                    return
+                elif len(roi_list) > 64:
+                    self.popup_box('Error!', 'Too many regions (max 64).')
+                    return
+
+                (x1, y1, x2, y2), labels = rasterize_roi(roi_list, self.dcm_slice.shape)
+                image_region = self.dcm_slice[y1:y2, x1:x2]
+                keep = classify_pixel(image_region, extract_type, extract_param)
+                roi_count, union_count = count_roi(image_region, labels, keep, len(roi_list))
+                pixel_result, _ = extract_keep(image_region, labels != 0, keep)
+
+                self.count_window.setText(str(union_count))
+                self.extract_result(pixel_result, x1, y1, x2, y2)
+                self.statusBar().showMessage(', '.join(['Region %d: %d' % (idx, count)
+                                                        for idx, count in enumerate(roi_count, 1)]) +
+                                             ', Union: %d' % union_count)
+            else:
+                self.popup_box('Error!', 'Please draw desired region first.')
+        else:
+            self.popup_box('Error!', 'Please upload image.')
+
+    @timed_stage('sweep_threshold')
+    def sweep_threshold(self):
+        if self.first_load is False:
+            if self.patch_num > 0:
+                x1, y1, x2, y2, image_region, pixel_mask = self.extract_region()
+                if pixel_mask is None:
+                    self.popup_box('Error!', 'Selected region is too small for analysis.')
+                    return
+
+                if self.extract_rgb.isChecked():
+                    rgb_param = self.rgb_param()
+                    if rgb_param is None:
+                        return
+                    thresholds, counts = sweep_rgb(image_region, pixel_mask, *rgb_param)
+                    self.plot_curve('RGB threshold sweep - %s' % self.dcm_filename, thresholds, counts,
+                                    'Threshold', 'Count', labels=['Red', 'Green', 'Blue'], marks=rgb_param[3:])
+                else:
+                    valid_std = self.std_param()
+                    if valid_std is None:
+                        return
+                    thresholds, counts = sweep_std(image_region, pixel_mask)
+                    self.plot_curve('Stdev threshold sweep - %s' % self.dcm_filename, thresholds, counts,
+                                    'Stdev threshold', 'Count', marks=[valid_std])
+                self.statusBar().showMessage('Done')
+            else:
+                self.popup_box('Error!', 'Please draw desired region first.')
+        else:
+            self.popup_box('Error!', 'Please upload image.')
+
+    def plot_curve(self, title, x, y, x_label, y_label, labels=None, marks=None):
+        # labels: one curve per row of y, drawn in red, green and blue; marks: current settings as dashed lines
+        if self.curve_window is None:
+            self.curve_window = Qw.QMainWindow(self)
+            self.curve_fig = plt.Figure(figsize=(6, 4), dpi=100)
+            self.curve_canvas = FigureCanvas(self.curve_fig)
+            self.curve_window.setCentralWidget(self.curve_canvas)
+            self.curve_ax = self.curve_fig.add_subplot(1, 1, 1)
+
+        self.curve_ax.clear()
+        if labels is None:
+            self.curve_ax.plot(x, y, color='crimson')
+        else:
+            for curve, label, color in zip(y, labels, ('red', 'green', 'blue')):
+                self.curve_ax.plot(x, curve, color=color, label=label)
+            self.curve_ax.legend()
+        for mark, color in zip(marks or [], ('red', 'green', 'blue') if labels is not None else ('gray',)):
+            self.curve_ax.axvline(mark, color=color, linestyle='--', alpha=0.5)
+        self.curve_ax.set_xlabel(x_label)
+        self.curve_ax.set_ylabel(y_label)
+        self.curve_ax.grid(True, alpha=0.3)
+        self.curve_fig.tight_layout()
+        self.curve_canvas.draw()
+
+        self.curve_window.setWindowTitle(title)
+        self.curve_window.show()
+        self.curve_window.raise_()
+
+    def cine_fps(self):
+        if len(self.fps_edit.text()) > 0:
+            try:
+                return float(self.fps_edit.text())
+            except ValueError:
+                self.popup_box('Error!', 'Do not enter characters other than numbers.')
+                return None
+
+        frame_time = self.ds.get('FrameTime')
+        if frame_time:
+            return 1000. / float(frame_time)
+        for keyword in ('CineRate', 'RecommendedDisplayFrameRate'):
+            if self.ds.get(keyword):
+                return float(self.ds.get(keyword))
+        return default_fps
+
+    def play_cine(self):
+        if self.play_timer.isActive():
+            self.stop_cine()
+        elif self.first_load is False:
+            fps = self.cine_fps()
+            if fps is None:
+                return
+            elif fps <= 0:
+                self.popup_box('Error!', 'Please enter a positive frame rate.')
+                return
+
+            self.play_count = None
+            if self.live_count.isChecked() and self.patch_num > 0:
+                x1, y1, x2, y2 = self.roi_region()
+                extract_type, extract_param = self.extract_param()
+                if extract_param is not None and abs(x1 - x2) >= 2 and abs(y1 - y2) >= 2:
+                    pixel_mask = create_roi_mask(self.roi_type(), y2 - y1, x2 - x1)
+                    self.play_count = (pixel_mask, (x1, y1, x2, y2), extract_type, extract_param)
+
+            self.play_fps, self.play_first = fps, self.slice_index - 1
+            self.play_shown, self.play_dropped, self.play_report = 0, 0, 0
+            self.play_start = time.perf_counter()
+            self.play_timer.start(max(int(1000 / fps), 1))
+            self.play_btn.setText('Pause')
+        else:
+            self.popup_box('Error!', 'Please upload image.')
+
+    def stop_cine(self):
+        if self.play_timer.isActive():
+            self.play_timer.stop()
+            self.play_btn.setText('Play')
+
+    def play_tick(self):
+        # The frame is chosen from the wall clock, so frames are skipped instead of queued when drawing lags
+        elapsed = time.perf_counter() - self.play_start
+        frame_step = int(elapsed * self.play_fps)
+        slice_index = (self.play_first + frame_step) % self.slice_num + 1
+        if slice_index == self.slice_index and self.play_shown > 0:
+            return
+
+        self.play_shown += 1
+        self.play_dropped = frame_step + 1 - self.play_shown
+        self.slice_index = slice_index
+        self.dcm_slice = self.image_array[self.slice_index - 1]
+        self.show_image(self.dcm_slice)
+        self.canvas.draw_idle()
+        self.slice_label.setText('%d/%d' % (self.slice_index, self.slice_num))
+
+        if self.play_count is not None:
+            pixel_mask, region, extract_type, extract_param = self.play_count
+            frame_count = extract_frames(self.dcm_slice, pixel_mask, region, extract_type, extract_param)
+            self.count_window.setText(str(frame_count[0]))
+
+        if elapsed - self.play_report >= 1:
+            self.play_report = elapsed
+            self.statusBar().showMessage('Play: %.1f / %.1f fps (%d dropped)' % (
+                self.play_shown / elapsed, self.play_fps, self.play_dropped))
+
+    def file_next(self):
+        if self.first_load is False and self.file_num > 0:  # no files while a new tree is being scanned
             self.file_index = index_plus(self.file_index, self.file_num)
             self.view_image('file')
         else:
             self.popup_box('Error!', 'Please upload image.')
 
     def file_prev(self):
-        if self.first_load is False:
+        if self.first_load is False and self.file_num > 0:
             self.file_index = index_minus(self.file_index, self.file_num)
             self.view_image('file')
         else:
             self.popup_box('Error!', 'Please upload image.')
 
     def slice_next(self):
-        if self.first_load is False:
+        if self.first_load is False and self.file_num > 0:
             self.slice_index = index_plus(self.slice_index, self.slice_num)
             self.view_image('slice')
         else:
             self.popup_box('Error!', 'Please upload image.')
 
     def slice_prev(self):
-        if self.first_load is False:
+        if self.first_load is False and self.file_num > 0:
             self.slice_index = index_minus(self.slice_index, self.slice_num)
             self.view_image('slice')
         else:
@@ -948,13 +2738,273 @@ class ViewerUS(Qw.QMainWindow):
     def popup_box(self, popup_title, popup_message):
         Qw.QMessageBox.about(self, popup_title, popup_message)
 
+    def record_timings(self):
+        stage_timer.stop()
+        if self.timing_action.isChecked():
+            stage_timer.report = self.show_timing
+            stage_timer.start(track_memory=self.memory_action.isChecked())
+            self.statusBar().showMessage('Recording timings')
+        else:
+            self.statusBar().showMessage('Timings off (%d recorded)' % len(stage_timer.events))
+
+    def show_timing(self, name, seconds, peak, stages):
+        # Breakdown of the last operation by its direct stages; the operation's own message is kept in front
+        stage_text = ', '.join(['%s %.1f%s' % (stage, total * 1e3, ' x%d' % calls if calls > 1 else '')
+                                for stage, (total, calls, _) in stages.items()])
+        timing_text = '%s %.1f ms' % (name, seconds * 1e3)
+        if len(stage_text) > 0:
+            timing_text += ' (%s)' % stage_text
+        if peak is not None:
+            timing_text += ', peak %.1f MB' % (peak / 1024. ** 2)
+        message, _, last_timing = self.statusBar().currentMessage().partition('  |  ')
+        if name == 'canvas.draw' and len(last_timing) > 0:  # deferred paint of the operation shown before
+            timing_text = last_timing.split('; ')[0] + '; ' + timing_text
+        self.statusBar().showMessage(message + '  |  ' + timing_text if len(message) > 0 else timing_text)
+
+    def save_trace(self):
+        if len(stage_timer.events) == 0:
+            self.popup_box('Error!', 'No timings recorded. Turn on Profile > Record Timings first.')
+            return
+
+        trace_path, _ = Qw.QFileDialog.getSaveFileName(self, 'Save Trace', 'us_viewer_trace.json',
+                                                       'Trace (*.json)')
+        if trace_path == '':
+            return
+        try:
+            stage_timer.save(trace_path)
+        except OSError as e:
+            self.popup_box('Error!', 'Could not save the trace: %s' % e)
+            return
+        self.statusBar().showMessage('Trace saved: %s (%d events)' % (trace_path, len(stage_timer.events)))
+
+    def closeEvent(self, event):
+        self.stop_scan()
+        self.series_loader.shutdown()
+        super(ViewerUS, self).closeEvent(event)
+
     def run_app(self):
-        self.setGeometry(200, 40, widget_width + 70, widget_height + 10)
+        self.setGeometry(200, 40, widget_width + 70, widget_height + 35)
         self.setWindowTitle('US viewer v1.1')
         self.show()
 
 
+def check_region(image_array, region):
+    # Batch regions are given on the command line, so they are checked against every file's Rows/Columns
+    x1, y1, x2, y2 = region
+    rows, cols = image_array.shape[1:3]
+    if x1 < 0 or y1 < 0 or x2 > cols or y2 > rows:
+        raise ValueError('region (%d, %d, %d, %d) is outside the %d x %d frame' % (x1, y1, x2, y2, cols, rows))
+
+
+def analyze_series(dcm_path, roi_type, region, extract_type, extract_param, disk_cache_dir=None,
+                   frame_window=frame_cache_size, max_workers=decode_workers):
+    x1, y1, x2, y2 = region
+    disk_cache = DiskCache(disk_cache_dir) if disk_cache_dir is not None else None
+    image_array = FrameProvider(dcm_path, cache_size=frame_window, disk_cache=disk_cache, max_workers=max_workers)
+    check_region(image_array, region)
+    pixel_mask = create_roi_mask(roi_type, y2 - y1, x2 - x1)
+    return extract_frames(image_array, pixel_mask, region, extract_type, extract_param, chunk_size=frame_window)
+
+
+def count_block(block_name, shape, dtype, whole_frames, roi_type, region, extract_type, extract_param):
+    # Worker side of SharedExtractor: counts frames from a zero-copy view of a shared-memory block, cropped to
+    # region when the block holds whole frames. The mask is sized from region, as in analyze_series
+    x1, y1, x2, y2 = region
+    block = shared_memory.SharedMemory(name=block_name)
+    try:
+        frames = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+        if whole_frames:
+            frames = frames[:, y1:y2, x1:x2]
+        pixel_mask = create_roi_mask(roi_type, y2 - y1, x2 - x1)
+        frame_count = count_keep(frames, pixel_mask, classify_pixel(frames, extract_type, extract_param))
+        del frames  # the view must be gone before the block is closed
+    finally:
+        block.close()
+    return frame_count
+
+
+class SharedExtractor:
+    # Process pool for counting frames without pickling them: frames of a series go into a ring of shared-memory
+    # blocks (compressed frames are decoded straight into them, mapped or decoded series give their ROI crops)
+    # and workers count zero-copy views of those blocks. Only block names, the ROI, extract parameters and
+    # per-frame counts cross process boundaries, and memory stays at the ring size
+
+    def __init__(self, max_workers=None, chunk_size=frame_cache_size):
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.block_num = 2 * (max_workers or decode_workers)  # one block counted, one filled per worker
+        self.chunk_size = chunk_size
+
+    def extract(self, image_array, roi_type, region, extract_type, extract_param):
+        check_region(image_array, region)
+        x1, y1, x2, y2 = region
+        whole_frames = isinstance(image_array, FrameProvider) and image_array.array is None and \
+            image_array.is_compressed
+        if whole_frames:
+            frame_shape, dtype = image_array.shape[1:], pixel_dtype(image_array.ds)
+            blocks = ((start, None) for start in range(0, len(image_array), self.chunk_size))
+        elif isinstance(image_array, FrameProvider):
+            blocks = image_array.stream(window=self.chunk_size, region=region)
+        else:
+            blocks = ((start, image_array[start:start + self.chunk_size, y1:y2, x1:x2])
+                      for start in range(0, image_array.shape[0], self.chunk_size))
+
+        frame_count = np.zeros(len(image_array), dtype=np.int64)
+        created, free, pending = [], [], deque()
+        try:
+            for start, frame_region in blocks:
+                if frame_region is not None:
+                    frame_shape, dtype = frame_region.shape[1:], frame_region.dtype
+                shape = (min(self.chunk_size, len(image_array) - start),) + tuple(frame_shape)
+
+                if len(free) == 0 and len(created) >= self.block_num:
+                    self.collect(pending.popleft(), frame_count, free)
+                if len(free) > 0:
+                    block = free.pop()
+                else:
+                    block = shared_memory.SharedMemory(create=True, size=max(self.chunk_size * int(np.prod(
+                        frame_shape)) * np.dtype(dtype).itemsize, 1))
+                    created.append(block)
+
+                view = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+                if whole_frames:
+                    image_array.decode_frames(range(start, start + shape[0]), out=view)
+                else:
+                    view[...] = frame_region
+                del view
+                future = self.executor.submit(count_block, block.name, shape, np.dtype(dtype).str, whole_frames,
+                                              roi_type, region, extract_type, extract_param)
+                pending.append((start, block, future))
+
+            while len(pending) > 0:
+                self.collect(pending.popleft(), frame_count, free)
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+            for _, _, future in pending:
+                if not future.cancelled():
+                    try:
+                        future.result()  # a worker may still be reading the block
+                    except Exception:
+                        pass
+            for block in created:
+                block.close()
+                block.unlink()
+        return frame_count
+
+    def collect(self, task, frame_count, free):
+        start, block, future = task
+        block_count = future.result()
+        frame_count[start:start + len(block_count)] = block_count
+        free.append(block)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def run_batch(args):
+    file_list = sorted(glob.glob(os.path.join(args.batch + '/*.dcm')))
+    if len(file_list) == 0:
+        print('Error! No DICOM file in %s' % args.batch, file=sys.stderr)
+        return 1
+
+    region = sort_region(*args.region)
+    if abs(region[2] - region[0]) < 2 or abs(region[3] - region[1]) < 2:
+        print('Error! Selected region is too small for analysis.', file=sys.stderr)
+        return 1
+
+    if args.std is not None:
+        extract_type, extract_param = 'std', args.std
+    else:
+        if len(args.direction) != 3 or set(args.direction) - {'>', '<'}:
+            print('Error! Direction must be three of ">" or "<".', file=sys.stderr)
+            return 1
+        thres = [min(max(th, 0), 255) for th in args.rgb]
+        extract_param = tuple(d == '>' for d in args.direction) + tuple(thres)
+        extract_type = 'rgb'
+
+    frame_window = args.frame_window or frame_cache_size
+    if args.shared_memory:
+        # One series at a time, decoded with every core and counted by the pool from shared-memory blocks
+        extractor = SharedExtractor(max_workers=args.workers, chunk_size=frame_window)
+
+        def series_count(dcm_path):
+            image_array = FrameProvider(dcm_path, frame_window, disk_cache=DiskCache(args.disk_cache)
+                                        if args.disk_cache is not None else None)
+            return extractor.extract(image_array, args.roi, region, extract_type, extract_param)
+
+        results = ((dcm_path, lambda dcm_path=dcm_path: series_count(dcm_path)) for dcm_path in file_list)
+    else:
+        # Decoding threads per process share the cores left by the process pool
+        process_num = min(args.workers or decode_workers, len(file_list))
+        thread_num = max(decode_workers // process_num, 1)
+        extractor = ProcessPoolExecutor(max_workers=args.workers)
+        futures = [extractor.submit(analyze_series, dcm_path, args.roi, region, extract_type, extract_param,
+                                    args.disk_cache, frame_window, thread_num) for dcm_path in file_list]
+        results = ((dcm_path, future.result) for dcm_path, future in zip(file_list, futures))
+
+    failed = 0
+    try:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['file', 'frame', 'count'])
+            for dcm_path, result in results:
+                try:
+                    frame_count = result()
+                except Exception as e:
+                    print('Error! %s: %s' % (os.path.basename(dcm_path), e), file=sys.stderr)
+                    failed += 1
+                    continue
+                for frame_index, pixel_count in enumerate(frame_count, 1):
+                    writer.writerow([os.path.basename(dcm_path), frame_index, pixel_count])
+                print('%s: %d frames' % (os.path.basename(dcm_path), len(frame_count)))
+    finally:
+        extractor.shutdown()
+    if failed > 0:
+        print('Error! %d of %d files failed' % (failed, len(file_list)), file=sys.stderr)
+        return 1
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Viewer for doppler ultrasound')
+    parser.add_argument('--batch', metavar='DIR', help='analyze every *.dcm in DIR without the viewer')
+    parser.add_argument('--roi', choices=['ellipse', 'rectangle'], default='ellipse')
+    parser.add_argument('--region', type=int, nargs=4, metavar=('X1', 'Y1', 'X2', 'Y2'))
+    parser.add_argument('--rgb', type=int, nargs=3, metavar=('R', 'G', 'B'), default=[128, 128, 128])
+    parser.add_argument('--direction', default='><>', help='">" or "<" for each of R, G, B (default: ><>)')
+    parser.add_argument('--std', type=float, help='extract to stdev with this threshold instead of RGB')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', default='us_count.csv')
+    parser.add_argument('--disk-cache', metavar='DIR', help='keep decoded compressed series as .npy files in DIR')
+    parser.add_argument('--profile', action='store_true', help='start the viewer with stage timings recorded')
+    parser.add_argument('--frame-window', type=int, metavar='N',
+                        help='decoded frames held per series; bounds memory for cines larger than RAM '
+                             '(default: %d in batch mode, whole series within --series-cache in the viewer)'
+                             % frame_cache_size)
+    parser.add_argument('--series-cache', type=int, default=series_cache_budget // 1024 ** 2, metavar='MB',
+                        help='decoded frames kept for revisited series in the viewer (default: %(default)s)')
+    parser.add_argument('--shared-memory', action='store_true',
+                        help='count each series with all workers from shared memory; suits few long cines')
+    args, args.qt_args = parser.parse_known_args(argv)  # the viewer hands unknown options to Qt
+
+    if args.batch is not None and len(args.qt_args) > 0:
+        parser.error('unrecognized arguments: %s' % ' '.join(args.qt_args))
+    if args.batch is not None and args.region is None:
+        parser.error('--batch requires --region')
+    if args.workers is not None and args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.frame_window is not None and args.frame_window < 1:
+        parser.error('--frame-window must be at least 1')
+    if args.series_cache < 1:
+        parser.error('--series-cache must be at least 1')
+    return args
+
+
 if __name__ == '__main__':
+    args = parse_args()
+    if args.batch is not None:
+        sys.exit(run_batch(args))
+
     sys._excepthook = sys.excepthook
 
     def exception_hook(exctype, value, traceback):
@@ -963,7 +3013,8 @@ if __name__ == '__main__':
 
     sys.excepthook = exception_hook
 
-    app = Qw.QApplication(sys.argv)
-    viewer_us = ViewerUS()
+    app = Qw.QApplication(sys.argv[:1] + args.qt_args)
+    viewer_us = ViewerUS(args.disk_cache, args.frame_window, args.series_cache * 1024 ** 2)
+    viewer_us.timing_action.setChecked(args.profile)
     viewer_us.run_app()
     sys.exit(app.exec_())